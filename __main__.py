@@ -1,20 +1,25 @@
+import os
+
 import fire
 
+from arweave import transform_tags
+from multi import MultiTracker
 from tracker import Tracker
 
-
-# remove useless tags and flatten
-def transform_tags(tags: list[dict]) -> dict:
-    result = {}
-    for item in tags:
-        if item["name"] in {"App-Name", "Content-Type", "content-digest"}:
-            continue
-        result[item["name"].lower()] = item["value"]
-    return result
-
-
 if __name__ == "__main__":
-    tracker = Tracker(
-        tags=[{"name": "App-Name", "values": ["MirrorXYZ"]}], transformer=transform_tags
-    )
+    options = {
+        "compress_history": os.getenv("COMPRESS_HISTORY") == "1",
+        "blob_bodies": os.getenv("BLOB_BODIES") == "1",
+    }
+    # SOURCES=sources.json to track several apps, see MultiTracker.load
+    if sources := os.getenv("SOURCES"):
+        tracker = MultiTracker.load(
+            sources, transformers={"default": transform_tags}, **options
+        )
+    else:
+        tracker = Tracker(
+            tags=[{"name": "App-Name", "values": ["MirrorXYZ"]}],
+            transformer=transform_tags,
+            **options,
+        )
     fire.Fire(tracker)
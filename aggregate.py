@@ -0,0 +1,150 @@
+from typing import Optional
+
+import numpy as np
+
+from rollup import HyperLogLog
+
+DAY = 24 * 60 * 60
+
+
+# exact distinct values of a bucket, kept as a sorted array
+class _ExactSet(object):
+    def __init__(self):
+        self.values = np.empty(0, dtype=str)
+
+    def add(self, values: np.ndarray):
+        self.values = np.union1d(self.values, values)
+
+    def merge(self, other: "_ExactSet") -> "_ExactSet":
+        self.add(other.values)
+        return self
+
+    def count(self) -> int:
+        return len(self.values)
+
+
+# approximate distinct values of a bucket, a fixed 2KB whatever the window
+class _ApproxSet(object):
+    def __init__(self):
+        self.hll = HyperLogLog()
+
+    def add(self, values: np.ndarray):
+        for value in values.tolist():
+            self.hll.add(value)
+
+    def merge(self, other: "_ApproxSet") -> "_ApproxSet":
+        self.hll.merge(other.hll)
+        return self
+
+    def count(self) -> int:
+        return self.hll.count()
+
+
+# transactions grouped into fixed width time buckets, e.g. utc days,
+# fed chunk by chunk so memory grows with the buckets and not the transactions
+class BucketAggregator(object):
+    def __init__(self, origin: float = 0, width: float = DAY, exact: bool = True):
+        self.origin = origin
+        self.width = width
+        self.exact = exact
+        self.posts: dict[int, int] = {}
+        # bucket -> {"user": set, "unique_post": set}
+        self.distinct: dict[int, dict] = {}
+        # the transaction with the highest block
+        self.last_tx: Optional[dict] = None
+
+    def _new_set(self):
+        return _ExactSet() if self.exact else _ApproxSet()
+
+    # columns of one chunk, missing contributors and digests are empty strings
+    def add(
+        self,
+        heights: np.ndarray,
+        timestamps: np.ndarray,
+        contributors: np.ndarray,
+        digests: np.ndarray,
+    ):
+        if len(timestamps) == 0:
+            return
+        heights, timestamps = np.asarray(heights), np.asarray(timestamps)
+        last = np.lexsort((timestamps, heights))[-1]
+        tx = {
+            "block_height": int(heights[last]),
+            "block_timestamp": int(timestamps[last]),
+        }
+        if self.last_tx is None or (tx["block_height"], tx["block_timestamp"]) > (
+            self.last_tx["block_height"],
+            self.last_tx["block_timestamp"],
+        ):
+            self.last_tx = tx
+
+        buckets = np.floor((timestamps - self.origin) / self.width).astype(np.int64)
+        order = np.argsort(buckets, kind="stable")
+        keys, starts, counts = np.unique(
+            buckets[order], return_index=True, return_counts=True
+        )
+        columns = {"user": np.asarray(contributors), "unique_post": np.asarray(digests)}
+        for key, start, n in zip(keys.tolist(), starts.tolist(), counts.tolist()):
+            rows = order[start : start + n]
+            self.posts[key] = self.posts.get(key, 0) + n
+            if key not in self.distinct:
+                self.distinct[key] = {name: self._new_set() for name in columns}
+            for name, values in columns.items():
+                unique = np.unique(values[rows])
+                self.distinct[key][name].add(unique[unique != ""])
+
+    def metric(self, key: int) -> dict:
+        return {
+            "post": self.posts[key],
+            "user": self.distinct[key]["user"].count(),
+            "unique_post": self.distinct[key]["unique_post"].count(),
+        }
+
+    # [(bucket start timestamp, metric)] of buckets with transactions, oldest first
+    def series(self) -> list[tuple[float, dict]]:
+        return [
+            (self.origin + key * self.width, self.metric(key))
+            for key in sorted(self.posts)
+        ]
+
+    # metric over every bucket
+    def total(self) -> Optional[dict]:
+        if len(self.posts) == 0:
+            return None
+        merged = {"user": self._new_set(), "unique_post": self._new_set()}
+        for sets in self.distinct.values():
+            for name, s in sets.items():
+                merged[name].merge(s)
+        return {
+            "post": sum(self.posts.values()),
+            "user": merged["user"].count(),
+            "unique_post": merged["unique_post"].count(),
+        }
+
+
+def test_bucket_aggregator():
+    rng = np.random.default_rng(0)
+    n = 5000
+    timestamps = rng.integers(0, 3 * DAY, n)
+    heights = timestamps // 120
+    contributors = np.array([f"u{i}" if i else "" for i in rng.integers(0, 300, n)])
+    digests = np.array([f"d{i}" for i in rng.integers(0, 2000, n)])
+
+    exact = BucketAggregator()
+    approx = BucketAggregator(exact=False)
+    for agg in [exact, approx]:
+        for start in range(0, n, 1000):
+            rows = slice(start, start + 1000)
+            agg.add(heights[rows], timestamps[rows], contributors[rows], digests[rows])
+
+    series = exact.series()
+    assert [day for day, _ in series] == [0, DAY, 2 * DAY]
+    for day, m in series:
+        rows = (timestamps >= day) & (timestamps < day + DAY)
+        assert m["post"] == rows.sum()
+        assert m["user"] == len(set(contributors[rows]) - {""})
+        assert m["unique_post"] == len(set(digests[rows]))
+    users, posts = len(set(contributors) - {""}), len(set(digests))
+    assert exact.total() == {"post": n, "user": users, "unique_post": posts}
+    assert abs(approx.total()["unique_post"] - posts) < posts * 0.05
+    assert exact.last_tx["block_timestamp"] == timestamps.max()
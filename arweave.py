@@ -1,66 +1,34 @@
-import json
+import asyncio
+import copy
+import time
 from typing import Optional, List, Union
 
-import aiohttp
-from gql import gql, Client
-from gql.transport.aiohttp import AIOHTTPTransport
+import codec
+import instrument
+from cache import ContentCache
+from client import ContentClient
+from util import logger
 
-from util import logger, batch_get
+DEFAULT_MIN_BLOCK = 935000
+# lets posts of the same content be fetched once, see ContentCache
+CONTENT_DIGEST_TAG = "content-digest"
+# digests of paged txs not taken yet, e.g. of txs filtered as seen
+MAX_CONTENT_DIGESTS = 10000
 
 
-class ArweaveFetcher(object):
-    # tags are graphql str
-    # e.g. "[{ name: "App-Name", values: ["MirrorXYZ"] }]"
-    def __init__(
-        self,
-        tags: list[dict[str, Union[str, list[str]]]],
-        url="https://arweave.net",
-        timeout=30,
-        # mapping tags
-        tags_transformer=None,
-    ):
-        transport = AIOHTTPTransport(url=url + "/graphql", timeout=timeout)
-        self.client = Client(transport=transport, execute_timeout=timeout)
-        self.url = url
-        self.timeout = timeout
-        self.tags = tags
-        self.tags_transformer = tags_transformer
-
-    def execute(self, query: str, variables: dict = None) -> dict:
-        result = self.client.execute(gql(query), variable_values=variables)
-        return result
+# remove useless tags and flatten
+def transform_tags(tags: list[dict]) -> dict:
+    result = {}
+    for item in tags:
+        name = item["name"].lower()
+        if name in {"app-name", "content-type", CONTENT_DIGEST_TAG}:
+            continue
+        result[name] = item["value"]
+    return result
 
-    def current_block_height(self) -> int:
-        return self.execute(
-            """
-query {
-  blocks(first: 1, sort: HEIGHT_DESC) {
-    edges {
-      node {
-        height
-      }
-    }
-  }
-}
-        """
-        )["blocks"]["edges"][0]["node"]["height"]
 
-    def fetch_transactions(
-        self, cursor: Optional[str], min_block: Optional[int], limit=100
-    ) -> tuple[List[dict], bool, Optional[str]]:
-        if min_block is None:
-            min_block = 935000
-        logger.debug(f"start with cursor: {cursor}, min_block: {min_block}")
-        result = self.execute(
-            """
-query($cursor: String, $min_block: Int, $tags: [TagFilter!]!, $limit: Int!) {
-  transactions(
-    tags: $tags
-    sort: HEIGHT_ASC
-    first: $limit
-    after: $cursor
-    block: { min: $min_block }
-  ) {
+# fields of a transactions connection
+TRANSACTIONS_SELECTION = """
     edges {
       cursor
       node {
@@ -78,19 +46,260 @@ query($cursor: String, $min_block: Int, $tags: [TagFilter!]!, $limit: Int!) {
     pageInfo {
       hasNextPage
     }
+"""
+
+TRANSACTIONS_QUERY = f"""
+query(
+  $cursor: String
+  $min_block: Int
+  $max_block: Int
+  $tags: [TagFilter!]!
+  $limit: Int!
+) {{
+  transactions(
+    tags: $tags
+    sort: HEIGHT_ASC
+    first: $limit
+    after: $cursor
+    block: {{ min: $min_block, max: $max_block }}
+  ) {{{TRANSACTIONS_SELECTION}  }}
+}}
+"""
+
+BLOCKS_QUERY = """
+query {
+  blocks(first: 1, sort: HEIGHT_DESC) {
+    edges {
+      node {
+        height
+      }
+    }
   }
 }
-""",
-            variables={
-                "cursor": cursor,
-                "limit": limit,
-                "min_block": min_block,
-                "tags": self.tags,
-            },
+"""
+
+# variables of each aliased page, suffixed by its index
+RANGE_VARIABLES = ["cursor", "min_block", "max_block", "limit"]
+
+
+# one aliased transactions field per block range, r0: transactions(...) r1: ...
+def ranges_query(count: int) -> str:
+    params = "".join(
+        f"  $cursor{i}: String\n  $min_block{i}: Int\n  $max_block{i}: Int\n  $limit{i}: Int!\n"
+        for i in range(count)
+    )
+    fields = "".join(
+        f"""  r{i}: transactions(
+    tags: $tags
+    sort: HEIGHT_ASC
+    first: $limit{i}
+    after: $cursor{i}
+    block: {{ min: $min_block{i}, max: $max_block{i} }}
+  ) {{{TRANSACTIONS_SELECTION}  }}
+"""
+        for i in range(count)
+    )
+    return f"query(\n{params}  $tags: [TagFilter!]!\n) {{\n{fields}}}\n"
+
+
+# parsed documents by query text, gql is imported when the first one is needed
+_documents = {}
+
+
+def _document(query: str):
+    if query not in _documents:
+        from gql import gql
+
+        _documents[query] = gql(query)
+    return _documents[query]
+
+
+# edges per page, halved when responses are slow and grown while they are fast,
+# capped at what the gateway actually returns for a full page
+class PageSizer(object):
+    def __init__(
+        self,
+        limit: int = 100,
+        min_limit: int = 10,
+        max_limit: int = 100,
+        # seconds per request
+        target_latency: float = 2.0,
+    ):
+        self.limit = limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency = target_latency
+
+    # edges: of the pages that had more after them, so they could have been full
+    def observe(self, latency: float, limit: int, edges: list[int]):
+        if edges and min(edges) < limit:
+            # the gateway caps pages below what we asked for
+            self.max_limit = max(self.min_limit, min(edges))
+        if latency > self.target_latency:
+            self.limit = max(self.min_limit, limit // 2)
+        elif latency < self.target_latency / 2 and edges:
+            self.limit = max(self.limit, int(limit * 1.5))
+        self.limit = min(self.limit, self.max_limit)
+
+
+# one async gql session per event loop, kept open until close,
+# shared by fetchers of the same gateway
+class GraphQLSession(object):
+    def __init__(self, url: str, timeout: float):
+        self.url = url
+        self.timeout = timeout
+        self._client = None
+        self._session = None
+        self._loop = None
+
+    async def _connect(self):
+        loop = asyncio.get_running_loop()
+        if self._session is not None and self._loop is loop:
+            return self._session
+        from gql import Client
+        from gql.transport.aiohttp import AIOHTTPTransport
+
+        # a session of a closed loop cannot be reused, nor closed
+        transport = AIOHTTPTransport(url=self.url + "/graphql", timeout=self.timeout)
+        self._client = Client(transport=transport, execute_timeout=self.timeout)
+        self._session = await self._client.connect_async()
+        self._loop = loop
+        return self._session
+
+    async def execute(self, query: str, variables: dict = None) -> dict:
+        session = await self._connect()
+        return await session.execute(_document(query), variable_values=variables)
+
+    async def close(self):
+        if self._session is not None:
+            if self._loop is asyncio.get_running_loop():
+                await self._client.close_async()
+            self._client = self._session = self._loop = None
+
+
+class ArweaveFetcher(object):
+    # tags are graphql str
+    # e.g. "[{ name: "App-Name", values: ["MirrorXYZ"] }]"
+    def __init__(
+        self,
+        tags: list[dict[str, Union[str, list[str]]]],
+        url="https://arweave.net",
+        timeout=30,
+        # mapping tags
+        tags_transformer=None,
+        # options of ContentClient, e.g. max_connections, rate_limit, retries
+        content_client_options: dict = None,
+        cache: Optional[ContentCache] = None,
+    ):
+        # gql is imported when the first query runs
+        self.graphql = GraphQLSession(url, timeout)
+        self.page_size = PageSizer()
+        self.url = url
+        self.timeout = timeout
+        self.tags = tags
+        self.tags_transformer = tags_transformer
+        self.cache = cache
+        # tx id -> content digest of paged txs, kept out of the records
+        self.content_digests: dict[str, str] = {}
+        self.content_client = ContentClient(
+            timeout=timeout, **(content_client_options or {})
+        )
+
+    # a fetcher of other tags sharing the gateway session, the content
+    # connections and rate limit, and the content cache of this one
+    def with_tags(
+        self, tags: list[dict[str, Union[str, list[str]]]], tags_transformer=None
+    ) -> "ArweaveFetcher":
+        fetcher = copy.copy(self)
+        fetcher.page_size = PageSizer()
+        fetcher.content_digests = {}
+        fetcher.tags = tags
+        fetcher.tags_transformer = tags_transformer
+        return fetcher
+
+    async def current_block_height_async(self) -> int:
+        result = await self.execute_async(BLOCKS_QUERY)
+        return result["blocks"]["edges"][0]["node"]["height"]
+
+    @instrument.timed("graphql")
+    async def execute_async(self, query: str, variables: dict = None) -> dict:
+        return await self.graphql.execute(query, variables)
+
+    # limit: None to follow the page sizer
+    async def fetch_transactions_async(
+        self,
+        cursor: Optional[str],
+        min_block: Optional[int],
+        limit: int = None,
+        max_block: Optional[int] = None,
+    ) -> tuple[List[dict], bool, Optional[str]]:
+        pages = await self.fetch_ranges_async([(cursor, min_block, max_block)], limit)
+        return pages[0]
+
+    # the next page of each (cursor, min_block, max_block) range in one request
+    async def fetch_ranges_async(
+        self,
+        ranges: list[tuple[Optional[str], Optional[int], Optional[int]]],
+        limit: int = None,
+    ) -> list[tuple[List[dict], bool, Optional[str]]]:
+        adaptive = limit is None
+        limit = limit or self.page_size.limit
+        start = time.perf_counter()
+        if len(ranges) == 1:
+            cursor, min_block, max_block = ranges[0]
+            result = await self.execute_async(
+                TRANSACTIONS_QUERY,
+                variables=self._transactions_variables(
+                    cursor, min_block, max_block, limit
+                ),
+            )
+            connections = [result["transactions"]]
+        else:
+            variables = {"tags": self.tags}
+            for i, (cursor, min_block, max_block) in enumerate(ranges):
+                v = self._transactions_variables(cursor, min_block, max_block, limit)
+                for name in RANGE_VARIABLES:
+                    variables[f"{name}{i}"] = v[name]
+            result = await self.execute_async(ranges_query(len(ranges)), variables)
+            connections = [result[f"r{i}"] for i in range(len(ranges))]
+        instrument.count("graphql_pages", len(ranges))
+        pages = [self._parse_transactions(c) for c in connections]
+        if adaptive:
+            self.page_size.observe(
+                time.perf_counter() - start,
+                limit,
+                [len(txs) for txs, has_next, _ in pages if has_next],
+            )
+        return pages
+
+    def _transactions_variables(
+        self,
+        cursor: Optional[str],
+        min_block: Optional[int],
+        max_block: Optional[int],
+        limit: int,
+    ) -> dict:
+        if min_block is None:
+            min_block = DEFAULT_MIN_BLOCK
+        logger.debug(
+            f"start with cursor: {cursor}, min_block: {min_block}, max_block: {max_block}"
         )
-        has_next_page = result["transactions"]["pageInfo"]["hasNextPage"]
+        return {
+            "cursor": cursor,
+            "limit": limit,
+            "min_block": min_block,
+            "max_block": max_block,
+            "tags": self.tags,
+        }
 
-        edges = result["transactions"]["edges"]
+    # a transactions connection of the response
+    def _parse_transactions(
+        self, connection: dict
+    ) -> tuple[List[dict], bool, Optional[str]]:
+        has_next_page = connection["pageInfo"]["hasNextPage"]
+
+        edges = connection["edges"]
+        instrument.count("transactions_fetched", len(edges))
         next_cursor = edges[-1]["cursor"] if len(edges) > 0 else None
         return [self.edge_to_transaction(e) for e in edges], has_next_page, next_cursor
 
@@ -101,19 +310,39 @@ query($cursor: String, $min_block: Int, $tags: [TagFilter!]!, $limit: Int!) {
             "block_height": n["block"]["height"],
             "block_timestamp": n["block"]["timestamp"],
         }
+        for tag in n["tags"]:
+            if tag["name"].lower() == CONTENT_DIGEST_TAG:
+                self.content_digests[n["id"]] = tag["value"]
+                if len(self.content_digests) > MAX_CONTENT_DIGESTS:
+                    del self.content_digests[next(iter(self.content_digests))]
         if t := self.tags_transformer:
             converted = t(n["tags"])
             for k, v in converted.items():
                 result[k] = v
         else:
-            result["tags"] = json.dumps(n["tags"])
+            result["tags"] = codec.dumps_str(n["tags"])
         return result
 
-    async def batch_fetch_data(self, _ids: List[str]) -> [dict]:
+    # content digests of txs paged before, for batch_fetch_data
+    def take_content_digests(self, _ids: List[str]) -> dict[str, str]:
+        return {
+            _id: digest
+            for _id in _ids
+            if (digest := self.content_digests.pop(_id, None)) is not None
+        }
+
+    async def close(self):
+        await self.graphql.close()
+        await self.content_client.close()
+
+    # digests: optional tx id -> content digest, to reuse cached contents of other txs
+    async def batch_fetch_data(
+        self, _ids: List[str], digests: Optional[dict[str, str]] = None
+    ) -> [dict]:
         if len(_ids) == 0:
             return []
-
-        urls = [self.url + "/" + _id for _id in _ids]
+        digests = digests or {}
+        import aiohttp
 
         def resp_post_to_db_post(_id: str, post) -> dict:
             if not isinstance(post, dict):
@@ -138,8 +367,38 @@ query($cursor: String, $min_block: Int, $tags: [TagFilter!]!, $limit: Int!) {
             }
             if nft := post.get("nft"):
                 if len(nft) > 0:
-                    dbpost["nft"] = json.dumps(nft)
+                    dbpost["nft"] = codec.dumps_str(nft)
             return dbpost
 
-        results = await batch_get(urls, timeout=self.timeout, return_exceptions=True)
+        async def fetch(_id: str):
+            if self.cache and (post := self.cache.get(_id, digests.get(_id))):
+                return post
+            post = await self.content_client.get(self.url + "/" + _id)
+            if self.cache and isinstance(post, dict):
+                # cache as soon as it arrives, so a crashed run does not download it again
+                self.cache.put(_id, post, digests.get(_id))
+            return post
+
+        results = await asyncio.gather(
+            *[fetch(_id) for _id in _ids], return_exceptions=True
+        )
+        if self.cache:
+            self.cache.flush()
+            logger.debug(f"Content cache: {self.cache.stats()}")
         return [resp_post_to_db_post(_id, post) for _id, post in zip(_ids, results)]
+
+
+def test_page_sizer():
+    sizer = PageSizer(limit=100, min_limit=10, max_limit=100, target_latency=2)
+    # the gateway returned 40 of 100 with more after them
+    sizer.observe(0.5, 100, [40, 40])
+    assert sizer.limit == sizer.max_limit == 40
+    sizer.observe(5, 40, [40])
+    assert sizer.limit == 20
+    sizer.observe(0.5, 20, [20])
+    sizer.observe(0.5, 30, [30])
+    assert sizer.limit == 40
+    # the last page of a range says nothing about the size
+    sizer.observe(5, 40, [])
+    assert sizer.limit == 20
+    assert ranges_query(2).count(": transactions(") == 2
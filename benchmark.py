@@ -0,0 +1,460 @@
+import asyncio
+import bisect
+import json
+import multiprocessing
+import os
+import random
+import re
+import resource
+import shutil
+import tempfile
+import time
+
+import fire
+from aiohttp import web
+
+from arweave import DEFAULT_MIN_BLOCK, RANGE_VARIABLES, transform_tags
+import instrument
+from feed import generate_all_feeds, RenderCache
+from metric import Metric
+from tracker import Tracker
+from util import logger, open_shard
+
+BENCH_TAGS = [{"name": "App-Name", "values": ["MirrorXYZ"]}]
+
+
+# local stand-in of arweave.net, serving /graphql and /{id} from generated data
+class FakeGateway(object):
+    def __init__(
+        self,
+        transactions: int = 2000,
+        txs_per_block: int = 5,
+        # blocks are spread over the last days, so every metric window has data
+        days: float = 14,
+        # max edges of a page, whatever the client asks for
+        max_page_size: int = 100,
+        graphql_latency: float = 0.05,
+        content_latency: float = 0.02,
+        # content requests answered with 503, the client retries them
+        error_rate: float = 0.01,
+        # body bytes are log-normal around the median
+        body_median: int = 4000,
+        body_sigma: float = 1.0,
+        contributors: int = 200,
+        # posts published more than once share the original digest
+        duplicate_rate: float = 0.1,
+        seed: int = 0,
+    ):
+        self.max_page_size = max_page_size
+        self.graphql_latency = graphql_latency
+        self.content_latency = content_latency
+        self.error_rate = error_rate
+        self.body_median = body_median
+        self.body_sigma = body_sigma
+        self.seed = seed
+        self.stats = {"graphql": 0, "content": 0, "errors": 0}
+
+        rng = random.Random(seed)
+        now = int(time.time())
+        last_height = DEFAULT_MIN_BLOCK + (transactions - 1) // txs_per_block
+        block_time = days * 86400 / max(1, last_height - DEFAULT_MIN_BLOCK)
+        self.txs = []
+        for i in range(transactions):
+            height = DEFAULT_MIN_BLOCK + i // txs_per_block
+            digest = f"digest{i}"
+            if i > 0 and rng.random() < duplicate_rate:
+                digest = self.txs[rng.randrange(i)]["digest"]
+            self.txs.append(
+                {
+                    "id": f"{i:043d}",
+                    "height": height,
+                    "timestamp": int(now - (last_height - height) * block_time),
+                    "contributor": f"0x{rng.randrange(contributors):040x}",
+                    "digest": digest,
+                }
+            )
+        self.heights = [tx["height"] for tx in self.txs]
+        self.by_id = {tx["id"]: i for i, tx in enumerate(self.txs)}
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/graphql", self.graphql)
+        app.router.add_get("/{id}", self.content)
+        return app
+
+    async def graphql(self, request: web.Request) -> web.Response:
+        self.stats["graphql"] += 1
+        await asyncio.sleep(self.graphql_latency)
+        body = await request.json()
+        variables = body.get("variables") or {}
+        if "blocks" in body["query"]:
+            data = {"blocks": {"edges": [{"node": {"height": self.heights[-1]}}]}}
+        elif aliases := re.findall(r"\b(r\d+): transactions", body["query"]):
+            # a page per aliased range, variables suffixed by its index
+            data = {
+                alias: self._transactions(
+                    {
+                        name: variables.get(f"{name}{alias[1:]}")
+                        for name in RANGE_VARIABLES
+                    }
+                )
+                for alias in aliases
+            }
+        else:
+            data = {"transactions": self._transactions(variables)}
+        return web.json_response({"data": data})
+
+    def _transactions(self, variables: dict) -> dict:
+        start = 0
+        if (min_block := variables.get("min_block")) is not None:
+            start = bisect.bisect_left(self.heights, min_block)
+        end = len(self.txs)
+        if (max_block := variables.get("max_block")) is not None:
+            end = bisect.bisect_right(self.heights, max_block)
+        if cursor := variables.get("cursor"):
+            start = max(start, int(cursor) + 1)
+        limit = min(variables.get("limit") or 10, self.max_page_size)
+        page = range(start, min(start + limit, end))
+        return {
+            "edges": [{"cursor": str(i), "node": self._node(i)} for i in page],
+            "pageInfo": {"hasNextPage": start + len(page) < end},
+        }
+
+    def _node(self, i: int) -> dict:
+        tx = self.txs[i]
+        return {
+            "id": tx["id"],
+            "tags": [
+                {"name": "App-Name", "value": "MirrorXYZ"},
+                {"name": "Content-Type", "value": "application/json"},
+                {"name": "Contributor", "value": tx["contributor"]},
+                {"name": "Content-Digest", "value": f"content{i}"},
+                {"name": "Original-Content-Digest", "value": tx["digest"]},
+            ],
+            "block": {"height": tx["height"], "timestamp": tx["timestamp"]},
+        }
+
+    async def content(self, request: web.Request) -> web.Response:
+        self.stats["content"] += 1
+        await asyncio.sleep(self.content_latency)
+        i = self.by_id.get(request.match_info["id"])
+        if i is None:
+            raise web.HTTPNotFound()
+        if random.random() < self.error_rate:
+            self.stats["errors"] += 1
+            raise web.HTTPServiceUnavailable()
+        tx = self.txs[i]
+        return web.json_response(
+            {
+                "content": {
+                    "title": f"Post {i}",
+                    "body": self._body(i),
+                    "timestamp": tx["timestamp"],
+                },
+                "digest": f"content{i}",
+                "originalDigest": tx["digest"],
+                "authorship": {"contributor": tx["contributor"]},
+            }
+        )
+
+    # markdown of a random size, the same for every request of a post
+    def _body(self, i: int) -> str:
+        rng = random.Random(self.seed * 1000003 + i)
+        size = int(rng.lognormvariate(0, self.body_sigma) * self.body_median)
+        paragraph = (
+            f"Some **bold** and _italic_ text of post {i} with a "
+            "[link](https://mirror.xyz) and `code`.\n\n"
+        )
+        lines = [f"# Post {i}\n\n"]
+        while size > 0:
+            lines.append(paragraph if rng.random() < 0.8 else "- a list item\n")
+            size -= len(lines[-1])
+        return "".join(lines)
+
+
+def _serve(options: dict, conn):
+    gateway = FakeGateway(**options)
+
+    async def main():
+        runner = web.AppRunner(gateway.app(), access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        conn.send(runner.addresses[0][1])
+        # stop when the parent asks for stats
+        await asyncio.get_running_loop().run_in_executor(None, conn.recv)
+        conn.send({**gateway.stats, "peak_rss_mb": _peak_rss_mb()})
+        await runner.cleanup()
+
+    asyncio.run(main())
+
+
+# stage name -> latencies in seconds of the wrapped methods
+class _Timings(object):
+    def __init__(self):
+        self.samples: dict[str, list[float]] = {}
+
+    def wrap(self, obj, name: str, stage: str):
+        fn = getattr(obj, name)
+        samples = self.samples.setdefault(stage, [])
+        if asyncio.iscoroutinefunction(fn):
+
+            async def timed(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    samples.append(time.perf_counter() - start)
+
+        else:
+
+            def timed(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    samples.append(time.perf_counter() - start)
+
+        setattr(obj, name, timed)
+
+    def report(self) -> dict:
+        return {
+            stage: {
+                "count": len(samples),
+                "total": round(sum(samples), 4),
+                "p50": round(_percentile(samples, 50), 4),
+                "p99": round(_percentile(samples, 99), 4),
+            }
+            for stage, samples in self.samples.items()
+            if samples
+        }
+
+
+def _percentile(samples: list[float], q: float) -> float:
+    s = sorted(samples)
+    return s[min(len(s) - 1, int(len(s) * q / 100))]
+
+
+# high-water mark of the whole process, or of the largest finished child
+def _peak_rss_mb(who: int = resource.RUSAGE_SELF) -> float:
+    # KB on linux
+    return round(resource.getrusage(who).ru_maxrss / 1024, 1)
+
+
+def _bytes_written(folder: str) -> dict:
+    result = {}
+    for root, _, files in os.walk(folder):
+        rel = os.path.relpath(root, folder)
+        top = "." if rel == "." else rel.split(os.sep)[0]
+        for f in files:
+            size = os.path.getsize(os.path.join(root, f))
+            result[top] = result.get(top, 0) + size
+    result["total"] = sum(result.values())
+    return result
+
+
+class Benchmark(object):
+    def __init__(self, url: str, workdir: str):
+        self.url = url
+        self.workdir = workdir
+
+    def _tracker(self, timings: _Timings) -> Tracker:
+        tracker = Tracker(
+            tags=BENCH_TAGS,
+            transformer=transform_tags,
+            url=self.url,
+            # do not let the rate limit hide the rest of the pipeline
+            content_client_options={"rate_limit": 10000, "backoff": 0.05},
+        )
+        timings.wrap(tracker.fetcher, "fetch_ranges_async", "graphql")
+        timings.wrap(tracker.fetcher, "batch_fetch_data", "content")
+        timings.wrap(tracker, "_commit", "commit")
+        return tracker
+
+    # run a scenario in its own empty folder, trackers use relative paths,
+    # each scenario gets its own process so the peak rss is its own
+    def _scenario(self, name: str, fn) -> dict:
+        folder = os.path.join(self.workdir, name)
+        os.makedirs(folder, exist_ok=True)
+        cwd = os.getcwd()
+        os.chdir(folder)
+        instrument.registry.reset()
+        timings = _Timings()
+        start = time.perf_counter()
+        try:
+            result = fn(timings) or {}
+        finally:
+            os.chdir(cwd)
+        seconds = time.perf_counter() - start
+        if txs := result.get("transactions"):
+            result["tx_per_sec"] = round(txs / seconds, 1)
+        result.update(
+            {
+                "seconds": round(seconds, 3),
+                "stages": timings.report(),
+                "peak_rss_mb": _peak_rss_mb(),
+                # pool workers, e.g. of compaction or feed rendering
+                "workers_peak_rss_mb": _peak_rss_mb(resource.RUSAGE_CHILDREN),
+                "bytes_written": _bytes_written(folder),
+            }
+        )
+        logger.info(f"Benchmark {name}: {result}")
+        return result
+
+    def run_once(self, timings: _Timings) -> dict:
+        tracker = self._tracker(timings)
+        timings.wrap(tracker, "_run_once", "run_once")
+        try:
+            while tracker._run_once():
+                pass
+        finally:
+            tracker.writer.close()
+            tracker._run_async(tracker.fetcher.close())
+        return {"transactions": tracker.checkpoint.stats["transactions"]}
+
+    def start_tracking(self, timings: _Timings, keep_recent_count: int) -> dict:
+        tracker = self._tracker(timings)
+        timings.wrap(tracker, "generate_feed", "feed")
+        tracker.start_tracking(
+            keep_tracking=True, keep_recent_count=keep_recent_count, pipeline=True
+        )
+        return {"transactions": tracker.checkpoint.stats["transactions"]}
+
+    # ranges paged together, `workers` pages per request
+    def backfill(self, timings: _Timings, workers: int) -> dict:
+        tracker = self._tracker(timings)
+        tracker.backfill(from_block=DEFAULT_MIN_BLOCK, workers=workers)
+        return {"transactions": tracker.checkpoint.stats["transactions"]}
+
+    # metrics and feeds over the data of the start_tracking scenario
+    def outputs(self, timings: _Timings) -> dict:
+        source = os.path.join(self.workdir, "start_tracking")
+        for name in ["history", "posts.jsonl"]:
+            path = os.path.join(source, name)
+            if os.path.isdir(path):
+                shutil.copytree(path, name, dirs_exist_ok=True)
+            else:
+                shutil.copy(path, name)
+        os.makedirs("dist", exist_ok=True)
+        tracker = self._tracker(timings)
+        tracker._sync_rollup()
+        tracker._sync_columns()
+        tracker.writer.close()
+
+        def timed(stage: str, fn):
+            start = time.perf_counter()
+            fn()
+            timings.samples[stage] = [time.perf_counter() - start]
+
+        timed(
+            "metrics_rollup",
+            lambda: Metric(
+                rollup=tracker.rollup, columns=tracker.columns
+            ).generate_metrics("dist/metrics.json"),
+        )
+        timed("metrics_columns", lambda: self._metrics(Metric(columns=tracker.columns)))
+        timed("metrics_scan", lambda: self._metrics(Metric()))
+
+        with open_shard("posts.jsonl") as f:
+            posts = [p for p in map(json.loads, f) if "error" not in p]
+        cache = RenderCache(os.path.join("cache", "feed", "render.json"))
+        timed("feeds_cold", lambda: generate_all_feeds(posts, cache=cache))
+        timed("feeds_warm", lambda: generate_all_feeds(posts, cache=cache))
+        return {"posts": len(posts)}
+
+    @staticmethod
+    def _metrics(m: Metric):
+        m.generate_metrics("dist/metrics.json")
+
+
+# runs in a fresh interpreter, a forked one would start from the parent's peak
+def _run_scenario(url: str, workdir: str, name: str, kwargs: dict, conn):
+    bench = Benchmark(url, workdir)
+    conn.send(bench._scenario(name, lambda t: getattr(bench, name)(t, **kwargs)))
+
+
+def _scenario_process(url: str, workdir: str, name: str, **kwargs) -> dict:
+    context = multiprocessing.get_context("spawn")
+    conn, child_conn = context.Pipe()
+    process = context.Process(
+        target=_run_scenario, args=(url, workdir, name, kwargs, child_conn)
+    )
+    process.start()
+    child_conn.close()
+    try:
+        return conn.recv()
+    except EOFError:
+        process.join()
+        raise RuntimeError(f"Benchmark {name} exited with {process.exitcode}")
+    finally:
+        process.join()
+
+
+# run every scenario against a local gateway, results are written to output as json
+def run(
+    transactions: int = 2000,
+    page_size: int = 100,
+    graphql_latency: float = 0.05,
+    content_latency: float = 0.02,
+    error_rate: float = 0.01,
+    body_median: int = 4000,
+    body_sigma: float = 1.0,
+    keep_recent_count: int = 2000,
+    backfill_workers: int = 4,
+    seed: int = 0,
+    workdir: str = None,
+    output: str = "dist/benchmark.json",
+):
+    gateway_options = {
+        "transactions": transactions,
+        "max_page_size": page_size,
+        "graphql_latency": graphql_latency,
+        "content_latency": content_latency,
+        "error_rate": error_rate,
+        "body_median": body_median,
+        "body_sigma": body_sigma,
+        "seed": seed,
+    }
+    output = os.path.abspath(output)
+    keep_workdir = workdir is not None
+    workdir = os.path.abspath(workdir or tempfile.mkdtemp(prefix="arweave-bench-"))
+    os.environ.setdefault("GITHUB_ENV", os.path.join(workdir, "github_env"))
+
+    conn, child_conn = multiprocessing.Pipe()
+    server = multiprocessing.Process(
+        target=_serve, args=(gateway_options, child_conn), daemon=True
+    )
+    server.start()
+    url = f"http://127.0.0.1:{conn.recv()}"
+    logger.info(f"Benchmark gateway at {url}, workdir {workdir}")
+
+    try:
+        results = {
+            "options": gateway_options,
+            "run_once": _scenario_process(url, workdir, "run_once"),
+            "start_tracking": _scenario_process(
+                url, workdir, "start_tracking", keep_recent_count=keep_recent_count
+            ),
+            "backfill": _scenario_process(
+                url, workdir, "backfill", workers=backfill_workers
+            ),
+            "outputs": _scenario_process(url, workdir, "outputs"),
+        }
+        conn.send("stop")
+        results["gateway"] = conn.recv()
+    finally:
+        server.join(timeout=5)
+        if server.is_alive():
+            server.terminate()
+        if not keep_workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as f:
+        f.write(json.dumps(results, indent=2))
+    logger.info(f"Benchmark results written to {output}")
+    return output
+
+
+if __name__ == "__main__":
+    fire.Fire(run)
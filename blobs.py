@@ -0,0 +1,69 @@
+import hashlib
+import os
+
+import instrument
+from util import atomic_write
+
+BODY_KEY = "body"
+# sha256 of the utf-8 body, and its length in characters
+BODY_REF_KEY = "body_ref"
+BODY_LENGTH_KEY = "body_length"
+
+
+# post bodies stored once by content hash, e.g. history/blobs/3f/3fa2...md,
+# so records only carry a reference and revisions with the same body share it
+class BlobStore(object):
+    def __init__(self, folder: str):
+        self.folder = folder
+
+    @staticmethod
+    def ref(data: bytes) -> str:
+        return hashlib.sha256(data).hexdigest()
+
+    def path(self, ref: str) -> str:
+        return os.path.join(self.folder, ref[:2], ref + ".md")
+
+    def put(self, body: str) -> str:
+        data = body.encode()
+        ref = self.ref(data)
+        path = self.path(ref)
+        if os.path.exists(path):
+            instrument.count("blob_deduplicated")
+            return ref
+        atomic_write(path, data)
+        instrument.count("blob_bytes_written", len(data))
+        return ref
+
+    def get(self, ref: str) -> str:
+        with open(self.path(ref), "rb") as f:
+            return f.read().decode()
+
+    # the post with its body replaced by a reference
+    def detach(self, post: dict) -> dict:
+        if BODY_KEY not in post:
+            return post
+        result = {k: v for k, v in post.items() if k != BODY_KEY}
+        result[BODY_REF_KEY] = self.put(post[BODY_KEY])
+        result[BODY_LENGTH_KEY] = len(post[BODY_KEY])
+        return result
+
+    # the post with its body read back, only called for posts that need it
+    def attach(self, post: dict) -> dict:
+        if BODY_REF_KEY not in post:
+            return post
+        result = {
+            k: v for k, v in post.items() if k not in {BODY_REF_KEY, BODY_LENGTH_KEY}
+        }
+        result[BODY_KEY] = self.get(post[BODY_REF_KEY])
+        return result
+
+
+def test_blob_store(tmp_path):
+    store = BlobStore(str(tmp_path))
+    a = store.detach({"id": "a", "body": "# 中文\nx"})
+    b = store.detach({"id": "b", "body": "# 中文\nx"})
+    assert a["body_ref"] == b["body_ref"] and a["body_length"] == 6
+    assert "body" not in a
+    assert len(os.listdir(tmp_path)) == 1
+    assert store.attach(a) == {"id": "a", "body": "# 中文\nx"}
+    assert store.detach({"id": "c", "error": {}}) == {"id": "c", "error": {}}
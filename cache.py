@@ -0,0 +1,182 @@
+import json
+import os
+import time
+from typing import Optional
+
+import codec
+from util import logger, atomic_write
+
+
+# on-disk cache of gateway contents, keyed by tx id
+# the digest index allows reusing the content of another tx with the same content digest,
+# the tx then points to the file of the other one
+class ContentCache(object):
+    index_filename = "index.json"
+
+    def __init__(self, folder: str, max_bytes: int = 512 * 1024 * 1024):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        os.makedirs(folder, exist_ok=True)
+
+        # id -> [size, digest, last_used]
+        self.entries: dict[str, list] = {}
+        # digest -> id
+        self.digests: dict[str, str] = {}
+        # id -> id of the file with its content
+        self.aliases: dict[str, str] = {}
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._dirty = False
+        # the index is read on first use, a run may not fetch anything
+        self._loaded = False
+
+    def _path(self, _id: str) -> str:
+        return os.path.join(self.folder, _id[:2], _id + ".json")
+
+    def _load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        path = os.path.join(self.folder, self.index_filename)
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path, "r") as f:
+                index = json.load(f)
+        except ValueError as e:
+            logger.warning(f"Ignore broken cache index {path}: {e}")
+            return
+        self.entries = index.get("entries", {})
+        self.digests = index.get("digests", {})
+        self.aliases = index.get("aliases", {})
+        self.total_bytes = sum(e[0] for e in self.entries.values())
+
+    def get(self, _id: str, digest: Optional[str] = None) -> Optional[dict]:
+        self._load()
+        post = self._read(_id)
+        if post is None and (
+            other := self.aliases.get(_id) or (digest and self.digests.get(digest))
+        ):
+            post = self._read(other)
+            if post is None:
+                if self.aliases.pop(_id, None):
+                    self._dirty = True
+            elif other != _id and self.aliases.get(_id) != other:
+                # same content, point this tx to it instead of copying it
+                self.aliases[_id] = other
+                self._dirty = True
+        if post is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return post
+
+    def _read(self, _id: str) -> Optional[dict]:
+        path = self._path(_id)
+        try:
+            with open(path, "rb") as f:
+                post = codec.loads(f.read())
+        except (OSError, ValueError):
+            if _id in self.entries:
+                self._forget(_id)
+            return None
+
+        if _id not in self.entries:
+            # written by a crashed run before its index was saved
+            self.entries[_id] = [os.path.getsize(path), None, 0]
+            self.total_bytes += self.entries[_id][0]
+        self.entries[_id][2] = time.time()
+        self._dirty = True
+        return post
+
+    def put(self, _id: str, post: dict, digest: Optional[str] = None):
+        self._load()
+        path = self._path(_id)
+        data = codec.dumps(post)
+        atomic_write(path, data)
+
+        if _id in self.entries:
+            self.total_bytes -= self.entries[_id][0]
+        size = len(data)
+        self.entries[_id] = [size, digest, time.time()]
+        self.total_bytes += size
+        if digest:
+            self.digests[digest] = _id
+        self.aliases.pop(_id, None)
+        self._dirty = True
+
+    def _forget(self, _id: str):
+        size, digest, _ = self.entries.pop(_id)
+        self.total_bytes -= size
+        if digest and self.digests.get(digest) == _id:
+            del self.digests[digest]
+        self._dirty = True
+
+    # evict least recently used entries until the cache fits, then save index
+    def flush(self):
+        evictions = self.evictions
+        if self.total_bytes > self.max_bytes:
+            for _id, _ in sorted(self.entries.items(), key=lambda e: e[1][2]):
+                if self.total_bytes <= self.max_bytes * 0.9:
+                    break
+                self._forget(_id)
+                self.evictions += 1
+                try:
+                    os.remove(self._path(_id))
+                except FileNotFoundError:
+                    pass
+        if self.evictions > evictions:
+            self.aliases = {k: v for k, v in self.aliases.items() if v in self.entries}
+
+        if not self._dirty:
+            return
+        index = {
+            "entries": self.entries,
+            "digests": self.digests,
+            "aliases": self.aliases,
+        }
+        atomic_write(os.path.join(self.folder, self.index_filename), json.dumps(index))
+        self._dirty = False
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self.entries),
+            "aliases": len(self.aliases),
+            "bytes": self.total_bytes,
+        }
+
+
+def test_content_cache(tmp_path, monkeypatch):
+    clock = iter(range(1, 1000))
+    monkeypatch.setattr(time, "time", lambda: next(clock))
+    folder = str(tmp_path)
+    post = lambda i: {"content": {"body": str(i) * 40}}
+    cache = ContentCache(folder, max_bytes=150)
+    cache.put("a0", post(0), "d0")
+    cache.put("b1", post(1))
+    # another tx of the same content points to the cached file
+    assert cache.get("c0", "d0") == post(0) and cache.aliases == {"c0": "a0"}
+    assert not os.path.exists(cache._path("c0"))
+    cache.flush()
+
+    # a crashed run left a file but did not save the index
+    atomic_write(cache._path("e2"), codec.dumps(post(2)))
+    cache = ContentCache(folder, max_bytes=150)
+    assert cache.get("c0") == post(0)
+    assert cache.get("e2") == post(2) and "e2" in cache.entries
+    # the least recently used goes first
+    cache.flush()
+    assert cache.evictions == 1 and sorted(cache.entries) == ["a0", "e2"]
+    assert cache.get("b1") is None
+    # and with it the txs pointing to it
+    cache.get("e2")
+    cache.put("f3", post(3))
+    cache.flush()
+    assert sorted(cache.entries) == ["e2", "f3"] and cache.aliases == {}
+    cache = ContentCache(folder)
+    assert cache.get("c0", "d0") is None and cache.get("e2") == post(2)
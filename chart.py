@@ -0,0 +1,81 @@
+import math
+from xml.sax.saxutils import escape
+
+COLORS = ["#1f77b4", "#ff7f0e", "#2ca02c", "#d62728", "#9467bd", "#8c564b"]
+
+
+# y axis ticks at 1, 2 or 5 times a power of 10
+def _ticks(max_value: float, count: int = 5) -> list[float]:
+    if max_value <= 0:
+        return [0, 1]
+    raw = max_value / count
+    magnitude = 10 ** math.floor(math.log10(raw))
+    step = next(m * magnitude for m in [1, 2, 5, 10] if m * magnitude >= raw)
+    return [i * step for i in range(math.ceil(max_value / step) + 1)]
+
+
+# line chart of series sharing the x labels, as a standalone svg document
+def line_chart_svg(
+    labels: list[str],
+    series: dict[str, list[float]],
+    width: int = 1200,
+    height: int = 800,
+) -> str:
+    left, right, top, bottom = 70, 20, 20, 60
+    plot_w = width - left - right
+    plot_h = height - top - bottom
+    values = [v for vs in series.values() for v in vs if v is not None]
+    ticks = _ticks(max(values, default=0))
+    y_max = ticks[-1]
+
+    def x(i: int) -> float:
+        if len(labels) <= 1:
+            return left + plot_w / 2
+        return left + plot_w * i / (len(labels) - 1)
+
+    def y(v: float) -> float:
+        return top + plot_h - plot_h * v / y_max
+
+    parts = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" '
+        f'viewBox="0 0 {width} {height}" font-family="sans-serif" font-size="12">',
+        f'<rect width="{width}" height="{height}" fill="white"/>',
+    ]
+    for t in ticks:
+        parts.append(
+            f'<line x1="{left}" y1="{y(t):.1f}" x2="{width - right}" y2="{y(t):.1f}" stroke="#ddd"/>'
+            f'<text x="{left - 8}" y="{y(t) + 4:.1f}" text-anchor="end">{t:g}</text>'
+        )
+    # thin out x labels so they do not overlap
+    every = max(1, math.ceil(len(labels) * 60 / plot_w))
+    for i, label in enumerate(labels):
+        if i % every == 0:
+            parts.append(
+                f'<text x="{x(i):.1f}" y="{height - bottom + 20}" text-anchor="middle">{escape(label)}</text>'
+            )
+    for n, (name, vs) in enumerate(series.items()):
+        color = COLORS[n % len(COLORS)]
+        points = " ".join(
+            f"{x(i):.1f},{y(v):.1f}" for i, v in enumerate(vs) if v is not None
+        )
+        parts.append(
+            f'<polyline points="{points}" fill="none" stroke="{color}" stroke-width="2"/>'
+        )
+        legend_y = top + 16 + n * 18
+        parts.append(
+            f'<line x1="{left + 12}" y1="{legend_y - 4}" x2="{left + 36}" y2="{legend_y - 4}" stroke="{color}" stroke-width="2"/>'
+            f'<text x="{left + 42}" y="{legend_y}">{escape(name)}</text>'
+        )
+    parts.append("</svg>")
+    return "\n".join(parts)
+
+
+def test_line_chart_svg():
+    import xml.etree.ElementTree as ET
+
+    assert _ticks(87) == [0, 20, 40, 60, 80, 100]
+    svg = line_chart_svg(["a", "b", "<c>"], {"post": [1, 5, 3], "user": [0, 2, None]})
+    root = ET.fromstring(svg)
+    polylines = root.findall("{http://www.w3.org/2000/svg}polyline")
+    assert len(polylines) == 2
+    assert len(polylines[1].get("points").split()) == 2
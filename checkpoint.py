@@ -0,0 +1,128 @@
+import json
+import os
+import time
+from typing import Optional
+
+import codec
+from util import logger, atomic_write, read_lines_reversed
+
+
+# where to resume tracking, saved with every committed batch
+class Checkpoint(object):
+    def __init__(self, path: str):
+        self.path = path
+        self.cursor: Optional[str] = None
+        # a cursor is only valid for the query it comes from
+        self.cursor_min_block: Optional[int] = None
+        self.block_height: Optional[int] = None
+        # ids already saved in block_height, a block may span several pages
+        self.boundary_ids: set[str] = set()
+        self.stats = {
+            "transactions": 0,
+            "posts": 0,
+            "errors": 0,
+            "batches": 0,
+            "updated_at": None,
+        }
+
+    @classmethod
+    def load(cls, path: str, transactions_path: str = None) -> "Checkpoint":
+        checkpoint = cls(path)
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                obj = json.load(f)
+            checkpoint.cursor = obj.get("cursor")
+            checkpoint.cursor_min_block = obj.get("cursor_min_block")
+            checkpoint.block_height = obj.get("block_height")
+            checkpoint.boundary_ids = set(obj.get("boundary_ids", []))
+            checkpoint.stats.update(obj.get("stats", {}))
+        elif transactions_path:
+            checkpoint._migrate(transactions_path)
+        return checkpoint
+
+    # build the first checkpoint from the tail of existing transactions
+    def _migrate(self, transactions_path: str):
+        for line in read_lines_reversed(transactions_path):
+            tx = codec.loads(line)
+            if self.block_height is None:
+                self.block_height = tx["block_height"]
+            elif tx["block_height"] != self.block_height:
+                break
+            self.boundary_ids.add(tx["id"])
+        if self.block_height is not None:
+            logger.info(
+                f"Migrated checkpoint from {transactions_path}: {self.block_height}, {len(self.boundary_ids)} ids"
+            )
+
+    # (cursor, min_block) to continue with
+    def query(self) -> tuple[Optional[str], Optional[int]]:
+        if self.cursor is not None:
+            return self.cursor, self.cursor_min_block
+        return None, self.block_height
+
+    def is_seen(self, tx: dict) -> bool:
+        if self.block_height is None:
+            return False
+        if tx["block_height"] != self.block_height:
+            return tx["block_height"] < self.block_height
+        return tx["id"] in self.boundary_ids
+
+    def advance(
+        self,
+        txs: list[dict],
+        cursor: Optional[str],
+        posts: list[dict] = (),
+        min_block: Optional[int] = None,
+    ):
+        for tx in txs:
+            if tx["block_height"] != self.block_height:
+                self.block_height = tx["block_height"]
+                self.boundary_ids = set()
+            self.boundary_ids.add(tx["id"])
+        if cursor is not None or len(txs) > 0:
+            self.cursor = cursor
+            self.cursor_min_block = min_block
+
+        errors = sum(1 for p in posts if "error" in p)
+        self.stats["transactions"] += len(txs)
+        self.stats["posts"] += len(posts) - errors
+        self.stats["errors"] += errors
+        self.stats["batches"] += 1
+        self.stats["updated_at"] = int(time.time())
+
+    def save(self):
+        atomic_write(
+            self.path,
+            json.dumps(
+                {
+                    "cursor": self.cursor,
+                    "cursor_min_block": self.cursor_min_block,
+                    "block_height": self.block_height,
+                    "boundary_ids": sorted(self.boundary_ids),
+                    "stats": self.stats,
+                },
+                indent=2,
+            ),
+        )
+
+
+def test_checkpoint(tmp_path):
+    path = str(tmp_path / "checkpoint.json")
+    c = Checkpoint.load(path)
+    assert not c.is_seen({"id": "a", "block_height": 1})
+
+    c.advance(
+        [{"id": "a", "block_height": 1}, {"id": "b", "block_height": 2}],
+        cursor="c1",
+        posts=[{"id": "a"}, {"id": "b", "error": {}}],
+        min_block=1,
+    )
+    c.save()
+
+    c = Checkpoint.load(path)
+    assert c.query() == ("c1", 1)
+    assert c.is_seen({"id": "a", "block_height": 1})
+    assert c.is_seen({"id": "b", "block_height": 2})
+    assert not c.is_seen({"id": "c", "block_height": 2})
+    assert not c.is_seen({"id": "d", "block_height": 3})
+    assert c.stats["posts"] == 1 and c.stats["errors"] == 1
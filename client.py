@@ -0,0 +1,166 @@
+import asyncio
+import random
+import time
+from email.utils import parsedate_to_datetime
+from typing import Optional
+from urllib.parse import urlsplit
+
+import instrument
+from util import logger
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class TokenBucket(object):
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated_at) * self.rate
+            )
+            self.updated_at = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+# long-lived http client for gateway contents
+# keep-alive connections are shared by all batches of the same event loop
+class ContentClient(object):
+    def __init__(
+        self,
+        timeout: int = 10,
+        max_connections: int = 64,
+        max_per_host: int = 16,
+        # requests per second, None to disable
+        rate_limit: Optional[float] = 20,
+        burst: Optional[float] = None,
+        retries: int = 4,
+        backoff: float = 0.5,
+        max_backoff: float = 30,
+    ):
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.max_per_host = max_per_host
+        self.bucket = TokenBucket(rate_limit, burst) if rate_limit else None
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self._session: Optional["aiohttp.ClientSession"] = None
+        self._loop = None
+        self._host_semaphores: dict[str, asyncio.Semaphore] = {}
+
+    def _ensure_session(self) -> "aiohttp.ClientSession":
+        import aiohttp
+
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._loop is not loop:
+            if self._session is not None and not self._session.closed:
+                logger.debug("Event loop changed, recreating content session")
+            connector = aiohttp.TCPConnector(
+                limit=self.max_connections,
+                limit_per_host=self.max_per_host,
+                ttl_dns_cache=300,
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+            self._loop = loop
+            self._host_semaphores = {}
+        return self._session
+
+    def _semaphore(self, url: str) -> asyncio.Semaphore:
+        host = urlsplit(url).netloc
+        if host not in self._host_semaphores:
+            self._host_semaphores[host] = asyncio.Semaphore(self.max_per_host)
+        return self._host_semaphores[host]
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    @instrument.timed("content_fetch")
+    async def get(self, url: str):
+        import aiohttp
+
+        try:
+            return await self._get(url)
+        except aiohttp.ClientResponseError as e:
+            instrument.count("content_errors", status=e.status)
+            raise
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            instrument.count("content_errors", status=type(e).__name__)
+            raise
+
+    async def _get(self, url: str):
+        import aiohttp
+
+        session = self._ensure_session()
+        attempt = 0
+        while True:
+            retry_after = None
+            try:
+                async with self._semaphore(url):
+                    if self.bucket:
+                        await self.bucket.acquire()
+                    async with session.get(
+                        url, timeout=aiohttp.ClientTimeout(total=self.timeout)
+                    ) as resp:
+                        if resp.status not in RETRY_STATUSES:
+                            resp.raise_for_status()
+                            return await resp.json(content_type=None)
+                        retry_after = _parse_retry_after(
+                            resp.headers.get("Retry-After")
+                        )
+                        resp.raise_for_status()
+            except aiohttp.ClientResponseError as e:
+                if e.status not in RETRY_STATUSES or attempt >= self.retries:
+                    raise
+                error = e
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if attempt >= self.retries:
+                    raise
+                error = e
+
+            instrument.count(
+                "content_retries", status=getattr(error, "status", type(error).__name__)
+            )
+            delay = self._retry_delay(attempt, retry_after)
+            attempt += 1
+            logger.debug(f"Retry {attempt} {url} in {delay:.2f}s: {error!r}")
+            await asyncio.sleep(delay)
+
+    # full jitter backoff, but never earlier than the server asks
+    def _retry_delay(self, attempt: int, retry_after: Optional[float]) -> float:
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_backoff))
+        return delay
+
+
+def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def test_parse_retry_after():
+    assert _parse_retry_after(None) is None
+    assert _parse_retry_after("3") == 3.0
+    assert _parse_retry_after("-1") == 0.0
+    assert _parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0.0
+    assert _parse_retry_after("soon") is None
@@ -0,0 +1,154 @@
+import json
+import re
+import sys
+from typing import Any, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+# integers orjson cannot hold exactly, it parses them as floats
+_BIG_INT = re.compile(rb"\d{19}")
+
+
+# compact json in utf-8 bytes, the same output with either backend
+def dumps(obj) -> bytes:
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj)
+        except orjson.JSONEncodeError:
+            # e.g. integers beyond 64 bits in gateway json
+            pass
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def dumps_str(obj) -> str:
+    return dumps(obj).decode()
+
+
+# one jsonl line, ready to be written
+def dumps_line(obj) -> bytes:
+    return dumps(obj) + b"\n"
+
+
+def loads(data: Union[bytes, str]):
+    if msgspec is not None:
+        return msgspec.json.decode(data)
+    if orjson is not None:
+        raw = data if isinstance(data, bytes) else data.encode()
+        if not _BIG_INT.search(raw):
+            return orjson.loads(data)
+    return json.loads(data)
+
+
+# typed records decoded straight from a line into a struct, keys not listed are
+# skipped without building them, attribute -> record key
+TRANSACTION_KEYS = {
+    "id": "id",
+    "block_height": "block_height",
+    "block_timestamp": "block_timestamp",
+    "contributor": "contributor",
+    "digest": "original-content-digest",
+    "error": "error",
+}
+POST_KEYS = {
+    "id": "id",
+    "title": "title",
+    "body": "body",
+    "body_ref": "body_ref",
+    "body_length": "body_length",
+    "timestamp": "timestamp",
+    "digest": "digest",
+    "contributor": "contributor",
+    "error": "error",
+}
+
+
+# missing keys are None, without msgspec the line is decoded to a dict first
+class _Record(object):
+    __slots__ = ()
+    record_keys: dict[str, str] = {}
+
+    def __init__(self, **kwargs):
+        for attr in self.record_keys:
+            setattr(self, attr, kwargs.get(attr))
+
+    def __eq__(self, other) -> bool:
+        return type(other) is type(self) and asdict(other) == asdict(self)
+
+
+def _record_type(name: str, keys: dict[str, str]):
+    if msgspec is not None:
+        return msgspec.defstruct(
+            name,
+            [(attr, Any, None) for attr in keys],
+            rename=keys,
+            namespace={"record_keys": keys},
+        )
+    return type(name, (_Record,), {"__slots__": tuple(keys), "record_keys": keys})
+
+
+Transaction = _record_type("Transaction", TRANSACTION_KEYS)
+Post = _record_type("Post", POST_KEYS)
+_decoders = {}
+
+
+def decode(data: Union[bytes, str], record_type):
+    if msgspec is not None:
+        if record_type not in _decoders:
+            _decoders[record_type] = msgspec.json.Decoder(record_type)
+        return _decoders[record_type].decode(data)
+    obj = loads(data)
+    if not isinstance(obj, dict):
+        raise ValueError(f"Not a record: {data[:100]!r}")
+    return record_type(**{a: obj.get(k) for a, k in record_type.record_keys.items()})
+
+
+def decode_transaction(data: Union[bytes, str]) -> Transaction:
+    return decode(data, Transaction)
+
+
+def decode_post(data: Union[bytes, str]) -> Post:
+    return decode(data, Post)
+
+
+# the record as a dict of its record keys, without missing ones
+def asdict(record) -> dict:
+    return {
+        key: value
+        for attr, key in record.record_keys.items()
+        if (value := getattr(record, attr)) is not None
+    }
+
+
+def test_codec(monkeypatch):
+    obj = {"id": "a", "body": '中文\n"x"', "n": [1, None, True], "big": 2**70}
+    line = dumps_line(obj)
+    tx = {"id": "t", "block_height": 1, "original-content-digest": "d", "tags": "[]"}
+    records = [
+        (Transaction, tx, {k: v for k, v in tx.items() if k != "tags"}),
+        (Post, obj, {"id": "a", "body": obj["body"]}),
+    ]
+    for backends in [(), ("msgspec",), ("msgspec", "orjson")]:
+        # every backend gives the same output as the one below
+        with monkeypatch.context() as m:
+            for backend in backends:
+                m.setitem(globals(), backend, None)
+            m.setattr(sys.modules[__name__], "_decoders", {})
+            assert dumps_line(obj) == line
+            assert loads(line) == loads(line.decode()) == obj
+            for record_type, record, expected in records:
+                decoded = decode(dumps(record), record_type)
+                assert asdict(decoded) == expected
+                assert decoded.id == record["id"]
+    try:
+        decode_post(line[:10])
+        assert False, "partial line decoded"
+    except ValueError:
+        pass
@@ -0,0 +1,142 @@
+import os
+import struct
+from typing import Iterable
+
+# column name -> (record key, struct format)
+# string columns are dictionary encoded per bucket, values in <bucket>.<column>.dict
+COLUMNS = {
+    "height": ("block_height", "<q"),
+    "timestamp": ("block_timestamp", "<q"),
+    "contributor": ("contributor", "<i"),
+    "digest": ("original-content-digest", "<i"),
+}
+DICT_COLUMNS = {"contributor", "digest"}
+NUMPY_DTYPES = {"<q": "<i8", "<i": "<i4"}
+
+
+# compact fixed width columns of transactions per history bucket,
+# e.g. history/columns/transactions_000935000.height
+class ColumnStore(object):
+    def __init__(self, folder: str, name: str = "transactions"):
+        self.folder = folder
+        self.name = name
+        os.makedirs(folder, exist_ok=True)
+        # (key, column) -> {value: id}
+        self._dicts: dict[tuple[int, str], dict[str, int]] = {}
+
+    def path(self, key: int, column: str) -> str:
+        return os.path.join(self.folder, f"{self.name}_{key:09d}.{column}")
+
+    def _dict(self, key: int, column: str) -> dict[str, int]:
+        if (key, column) not in self._dicts:
+            values = {}
+            path = self.path(key, column) + ".dict"
+            if os.path.exists(path):
+                with open(path, "r") as f:
+                    for i, line in enumerate(f):
+                        values[line.rstrip("\n")] = i
+            self._dicts[(key, column)] = values
+        return self._dicts[(key, column)]
+
+    # writer: ShardWriter, so column files share its buffered handles
+    def append(self, writer, key: int, txs: list[dict]):
+        if len(txs) == 0:
+            return
+        for column, (record_key, fmt) in COLUMNS.items():
+            if column in DICT_COLUMNS:
+                values = self._dict(key, column)
+                new_values = []
+                codes = []
+                for tx in txs:
+                    value = tx.get(record_key) or ""
+                    if value not in values:
+                        values[value] = len(values)
+                        new_values.append(value)
+                    codes.append(values[value])
+                if new_values:
+                    writer.write(
+                        self.path(key, column) + ".dict",
+                        ("\n".join(new_values) + "\n").encode(),
+                    )
+            else:
+                codes = [tx[record_key] for tx in txs]
+            writer.write(
+                self.path(key, column),
+                struct.pack(f"<{len(codes)}{fmt[1]}", *codes),
+            )
+
+    def row_count(self, key: int) -> int:
+        counts = []
+        for column, (_, fmt) in COLUMNS.items():
+            path = self.path(key, column)
+            size = os.path.getsize(path) if os.path.exists(path) else 0
+            counts.append(size // struct.calcsize(fmt))
+        return min(counts)
+
+    def remove(self, key: int):
+        for column in COLUMNS:
+            for path in [self.path(key, column), self.path(key, column) + ".dict"]:
+                if os.path.exists(path):
+                    os.remove(path)
+        for column in DICT_COLUMNS:
+            self._dicts.pop((key, column), None)
+
+    def keys(self) -> list[int]:
+        prefix = self.name + "_"
+        suffix = ".height"
+        return sorted(
+            int(p[len(prefix) : -len(suffix)])
+            for p in os.listdir(self.folder)
+            if p.startswith(prefix) and p.endswith(suffix)
+        )
+
+    # memory mapped columns of a bucket, dictionary columns come with their values
+    def load(self, key: int, columns: Iterable[str]) -> dict:
+        import numpy as np
+
+        rows = self.row_count(key)
+        result = {}
+        for column in columns:
+            _, fmt = COLUMNS[column]
+            path = self.path(key, column)
+            if rows == 0:
+                result[column] = np.empty(0, dtype=NUMPY_DTYPES[fmt])
+            else:
+                result[column] = np.memmap(
+                    path, dtype=NUMPY_DTYPES[fmt], mode="r", shape=(rows,)
+                )
+            if column in DICT_COLUMNS:
+                with open(path + ".dict", "r") as f:
+                    result[column + "_values"] = np.array(f.read().splitlines())
+        return result
+
+
+def test_column_store(tmp_path):
+    from writer import ShardWriter
+
+    store = ColumnStore(str(tmp_path))
+    writer = ShardWriter(max_bytes=1 << 30)
+    txs = [
+        {
+            "id": str(i),
+            "block_height": 1000 + i,
+            "block_timestamp": 1650000000 + i,
+            "contributor": f"c{i % 3}",
+            "original-content-digest": f"d{i // 2}",
+        }
+        for i in range(10)
+    ]
+    store.append(writer, 1000, txs[:5])
+    writer.flush()
+    # dictionaries are read back from disk
+    store = ColumnStore(str(tmp_path))
+    store.append(writer, 1000, txs[5:])
+    writer.close()
+
+    assert store.keys() == [1000]
+    assert store.row_count(1000) == 10
+    cols = store.load(1000, ["height", "contributor", "digest"])
+    assert list(cols["height"]) == list(range(1000, 1010))
+    contributors = cols["contributor_values"][cols["contributor"]]
+    assert list(contributors) == [tx["contributor"] for tx in txs]
+    assert len(cols["digest_values"]) == 5
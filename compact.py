@@ -0,0 +1,262 @@
+import gzip
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import codec
+from util import (
+    logger,
+    atomic_write,
+    history_files,
+    parse_shard_name,
+    open_shard,
+)
+
+# kinds of shards compacted together per bucket, transactions give posts their heights
+KINDS = ["transactions", "posts"]
+# lines of a gzip member in compressed shards, as _split_file frames them
+MEMBER_BYTES = 1024 * 1024
+TMP_SUFFIX = ".compact.tmp"
+# renames still to do of an interrupted compaction, one per bucket
+MANIFEST_SUFFIX = ".compact.json"
+# a worker holds the lines of a bucket, up to a few shards of 90MB
+DEFAULT_WORKERS = 2
+# sidecars of a shard that no longer match it once rewritten
+SIDECAR_SUFFIXES = [".idx"]
+
+
+# shards grouped by bucket, e.g. {935000: {"transactions": [...], "posts": [...]}},
+# each list from the oldest part to the base shard
+def _buckets(folder: str) -> dict[int, dict[str, list[str]]]:
+    result = {}
+    for kind in KINDS:
+        for path in history_files(folder, kind):
+            _, key, _ = parse_shard_name(path)
+            result.setdefault(key, {}).setdefault(kind, []).append(path)
+    return result
+
+
+# lines of shards in order, decoded as typed records for their id, error and height, the later record of an id wins unless it is an error,
+# only the raw line is kept per id, returns (lines sorted by height, whether any
+# moved, stats), heights of transactions are added to heights for their posts
+def _dedupe(paths: list[str], heights: dict[str, int], height_key: str = None):
+    # id -> (order, line, is_error)
+    kept: dict[str, tuple[int, bytes, bool]] = {}
+    records = broken = 0
+    for path in paths:
+        with open_shard(path) as f:
+            for line in f:
+                try:
+                    record = codec.decode_transaction(line)
+                except ValueError:
+                    # a partial line of a crashed run
+                    broken += 1
+                    continue
+                records += 1
+                if not line.endswith(b"\n"):
+                    line += b"\n"
+                _id = record.id
+                is_error = record.error is not None
+                height = getattr(record, height_key) if height_key else None
+                previous = kept.get(_id)
+                if previous is None:
+                    kept[_id] = (len(kept), line, is_error)
+                elif not is_error or previous[2]:
+                    # keep its place, runs append in height order
+                    kept[_id] = (previous[0], line, is_error)
+                else:
+                    continue
+                if height is not None:
+                    heights[_id] = height
+    entries = sorted(kept.items(), key=lambda v: (heights.get(v[0], -1), v[1][0]))
+    moved = any(order != i for i, (_, (order, _, _)) in enumerate(entries))
+    lines = [line for _, (_, line, _) in entries]
+    stats = {"records": records, "duplicates": records - len(kept)}
+    stats["broken_lines"] = broken
+    return lines, moved, stats
+
+
+# lines grouped into parts of at most max_bytes, compressed parts as ~1MB gzip
+# members, each part a list of blocks written one after another
+def _parts(lines: list[bytes], max_bytes: int, compress: bool) -> list[list[bytes]]:
+    blocks = lines
+    if compress:
+        blocks, block, size = [], [], 0
+        for line in lines:
+            block.append(line)
+            size += len(line)
+            if size >= MEMBER_BYTES:
+                blocks.append(gzip.compress(b"".join(block), compresslevel=6))
+                block, size = [], 0
+        if block:
+            blocks.append(gzip.compress(b"".join(block), compresslevel=6))
+    parts, current, size = [], [], 0
+    for block in blocks:
+        if current and size + len(block) > max_bytes:
+            parts.append(current)
+            current, size = [], 0
+        current.append(block)
+        size += len(block)
+    if current or not parts:
+        parts.append(current)
+    return parts
+
+
+# rewrite the shards of a bucket, runs in pool workers
+def compact_bucket(
+    folder: str, key: int, shards: dict[str, list[str]], max_bytes: int, compress: bool
+) -> dict:
+    ext = "jsonl.gz" if compress else "jsonl"
+    stats = {"shards_before": 0, "shards_after": 0, "bytes_before": 0}
+    stats.update(records=0, duplicates=0, broken_lines=0, bytes_after=0)
+    heights: dict[str, int] = {}
+    renames: list[list[str]] = []
+    old_paths: list[str] = []
+    for kind in KINDS:
+        paths = shards.get(kind, [])
+        if not paths:
+            continue
+        height_key = "block_height" if kind == "transactions" else None
+        lines, moved, kind_stats = _dedupe(paths, heights, height_key)
+        for k, v in kind_stats.items():
+            stats[k] += v
+        parts = _parts(lines, max_bytes, compress)
+        part_sizes = [sum(len(block) for block in part) for part in parts]
+        # the base shard is the newest, parts before it are numbered from 1
+        targets = [
+            os.path.join(folder, f"{kind}_{key:09d}.{i + 1}.{ext}")
+            for i in range(len(parts) - 1)
+        ] + [os.path.join(folder, f"{kind}_{key:09d}.{ext}")]
+        sizes = [os.path.getsize(p) for p in paths]
+        stats["shards_before"] += len(paths)
+        stats["bytes_before"] += sum(sizes)
+        stats["shards_after"] += len(targets)
+        stats["bytes_after"] += sum(part_sizes)
+        unchanged = (
+            paths == targets
+            and not moved
+            and kind_stats["duplicates"] == 0
+            and kind_stats["broken_lines"] == 0
+            and part_sizes == sizes
+        )
+        if unchanged:
+            continue
+        for target, part in zip(targets, parts):
+            with open(target + TMP_SUFFIX, "wb") as f:
+                f.writelines(part)
+                f.flush()
+                os.fsync(f.fileno())
+            renames.append([target + TMP_SUFFIX, target])
+        old_paths += [p for p in paths if p not in targets]
+    if renames:
+        # once the manifest is saved, finishing the renames is safe to repeat
+        manifest = os.path.join(folder, f"compact_{key:09d}{MANIFEST_SUFFIX}")
+        atomic_write(manifest, json.dumps({"renames": renames, "remove": old_paths}))
+        _finish(manifest)
+    stats["rewritten"] = [target for _, target in renames]
+    return stats
+
+
+def _finish(manifest: str):
+    with open(manifest, "r") as f:
+        obj = json.load(f)
+    for tmp, target in obj["renames"]:
+        if os.path.exists(tmp):
+            os.replace(tmp, target)
+    for path in obj["remove"]:
+        if os.path.exists(path):
+            os.remove(path)
+    for path in [target for _, target in obj["renames"]] + obj["remove"]:
+        for suffix in SIDECAR_SUFFIXES:
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+    os.remove(manifest)
+
+
+# finish compactions interrupted after their manifest was saved,
+# drop temporary files of those interrupted before
+def recover(folder: str):
+    if not os.path.isdir(folder):
+        return
+    names = os.listdir(folder)
+    for name in names:
+        if name.endswith(MANIFEST_SUFFIX):
+            logger.info(f"Finishing interrupted compaction {name}")
+            _finish(os.path.join(folder, name))
+    for name in os.listdir(folder):
+        if name.endswith(TMP_SUFFIX):
+            os.remove(os.path.join(folder, name))
+
+
+# dedupe, sort and re-split every bucket of history in a process pool
+def compact_history(
+    folder: str,
+    max_bytes: int,
+    compress: bool = False,
+    workers: int = DEFAULT_WORKERS,
+) -> dict:
+    recover(folder)
+    buckets = _buckets(folder)
+    report = {"buckets": len(buckets), "rewritten": []}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(compact_bucket, folder, key, shards, max_bytes, compress)
+            for key, shards in sorted(buckets.items())
+        ]
+        for future in futures:
+            for k, v in future.result().items():
+                if isinstance(v, list):
+                    report[k] += v
+                else:
+                    report[k] = report.get(k, 0) + v
+    report["reclaimed_bytes"] = report.get("bytes_before", 0) - report.get(
+        "bytes_after", 0
+    )
+    report["reclaimed_records"] = report.get("duplicates", 0) + report.get(
+        "broken_lines", 0
+    )
+    return report
+
+
+def test_compact_history(tmp_path):
+    folder = str(tmp_path)
+    tx = lambda i: {"id": f"t{i}", "block_height": 10 + i}
+    post = lambda i, **kw: {"id": f"t{i}", "title": "a", **kw}
+
+    def write(name: str, records: list[dict], tail: bytes = b""):
+        with open(os.path.join(folder, name), "wb") as f:
+            f.write(b"".join(codec.dumps_line(r) for r in records) + tail)
+
+    # a re-run appended 2 and 3 again, a crash left a partial line
+    write("transactions_000000000.1.json", [tx(3), tx(1), tx(2)])
+    write("transactions_000000000.jsonl", [tx(2), tx(3), tx(4)], b'{"id": "t')
+    # the base shard is the newest, a failed retry of t2 must not win
+    write("posts_000000000.2.jsonl", [post(2), post(3)])
+    write("posts_000000000.jsonl", [post(3, title="b"), post(1), post(2, error={})])
+    write("transactions_000001000.jsonl", [tx(1000)])
+
+    report = compact_history(folder, max_bytes=60)
+    assert report["duplicates"] == 4 and report["broken_lines"] == 1
+    assert report["reclaimed_bytes"] > 0
+    files = sorted(os.listdir(folder))
+    assert "transactions_000000000.1.json" not in files
+    assert "transactions_000001000.jsonl" not in report["rewritten"]
+
+    from shard_index import read_history
+
+    assert [t["id"] for t in read_history(folder, "transactions")] == [
+        "t1",
+        "t2",
+        "t3",
+        "t4",
+        "t1000",
+    ]
+    posts = list(read_history(folder, "posts"))
+    assert [(p["id"], p["title"], "error" in p) for p in posts] == [
+        ("t1", "a", False),
+        ("t2", "a", False),
+        ("t3", "b", False),
+    ]
+    # nothing left to do
+    again = compact_history(folder, max_bytes=60, workers=1)
+    assert again["rewritten"] == [] and again["reclaimed_bytes"] == 0
@@ -1,13 +1,24 @@
+import heapq
+import json
 import os.path
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from typing import Optional, Iterable
 
 import markdown
 from jsonfeed import JSONFeed
 
-from util import logger, put_github_action_env
+import codec
+import instrument
+from util import logger, put_github_action_files, atomic_write, chunks
 
 feed_filename = "posts.feed.json"
 mirror_link_feed_filename = "posts.feed.mirror.json"
+TINY_BODY_LINES = 3
+# longer bodies are cut before rendering, one huge post must not stall the feed
+MAX_BODY_CHARS = 200 * 1000
+# bodies rendered by a worker at a time
+RENDER_CHUNK_SIZE = 32
 
 all_feeds_options = [
     {
@@ -23,63 +34,209 @@ all_feeds_options = [
     {
         "filename": "posts.feed.tiny.json",
         "mirror_link": False,
-        "body_lines": 3,
+        "body_lines": TINY_BODY_LINES,
     },
     {
         "filename": "posts.feed.mirror.tiny.json",
         "mirror_link": True,
-        "body_lines": 3,
+        "body_lines": TINY_BODY_LINES,
     },
 ]
 
 
-def generate_all_feeds(posts: [dict]):
-    os.makedirs("dist", exist_ok=True)
+# rendered html of posts, full and tiny, kept between runs by post id
+class RenderCache(object):
+    # bump when rendering changes, so old html is not reused
+    version = 1
+
+    # path: None to only keep html in memory
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        self.entries: dict[str, list[str]] = {}
+        self.rendered = 0
+        if path and os.path.exists(path):
+            try:
+                with open(path, "r") as f:
+                    obj = json.load(f)
+                if obj.get("version") == self.version:
+                    self.entries = obj["entries"]
+            except ValueError as e:
+                logger.warning(f"Ignore broken render cache {path}: {e}")
+
+    def get(self, p: dict) -> tuple[str, str]:
+        if html := self.entries.get(p["id"]):
+            return html[0], html[1]
+        full, tiny = _render_post(p)
+        self.entries[p["id"]] = [full, tiny]
+        self.rendered += 1
+        return full, tiny
+
+    # render posts not in the cache in a process pool, in order of posts
+    @instrument.timed("markdown_render")
+    def render_missing(self, posts: list[dict], workers: int = None):
+        missing = list(
+            {
+                p["id"]: p
+                for p in posts
+                if "body" in p and p.get("id") not in self.entries
+            }.values()
+        )
+        if len(missing) <= RENDER_CHUNK_SIZE:
+            # not worth starting a pool
+            bodies = [p["body"] for p in missing]
+            results = [_render_chunk(bodies)]
+        else:
+            bodies = chunks([p["body"] for p in missing], RENDER_CHUNK_SIZE)
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(_render_chunk, bodies))
+        html = [h for chunk in results for h in chunk]
+        for p, (full, tiny) in zip(missing, html):
+            self.entries[p["id"]] = [full, tiny]
+        self.rendered += len(missing)
+        instrument.count("markdown_rendered", len(missing))
+
+    # keep only posts still in the feed
+    def save(self, ids: set[str]):
+        self.entries = {k: v for k, v in self.entries.items() if k in ids}
+        if self.path is None:
+            return
+        atomic_write(
+            self.path, json.dumps({"version": self.version, "entries": self.entries})
+        )
+
+
+# the newest count posts by timestamp, only the newest revision of each digest,
+# fed one post at a time, e.g. newest first, so memory stays at count posts
+class RecentPosts(object):
+    def __init__(self, count: int):
+        self.count = count
+        # (timestamp, -order, key), the oldest post on top, of those read at the
+        # same timestamp the one read last, replaced revisions are dropped lazily
+        self._heap: list[tuple] = []
+        # key -> (timestamp, order, post) of posts kept
+        self._posts: dict[str, tuple] = {}
+        self._order = 0
+
+    # the oldest timestamp kept once full, nothing older gets in
+    @property
+    def min_timestamp(self) -> Optional[float]:
+        if len(self._posts) < self.count or not self._heap:
+            return None
+        return self._heap[0][0]
+
+    def add(self, post: codec.Post):
+        timestamp = post.timestamp
+        if post.error is not None or timestamp is None:
+            return
+        key = post.digest or post.id
+        if current := self._posts.get(key):
+            if timestamp <= current[0]:
+                return
+        elif (min_timestamp := self.min_timestamp) is not None:
+            # a revision older than an evicted one never gets here either
+            if timestamp <= min_timestamp:
+                return
+        self._order += 1
+        self._posts[key] = (timestamp, self._order, post)
+        heapq.heappush(self._heap, (timestamp, -self._order, key))
+        self._trim()
+
+    def extend(self, posts: Iterable[codec.Post]):
+        for p in posts:
+            self.add(p)
+
+    def _trim(self):
+        if len(self._heap) > 2 * self.count:
+            self._heap = [(t, -o, k) for k, (t, o, _) in self._posts.items()]
+            heapq.heapify(self._heap)
+        while self._heap:
+            timestamp, order, key = self._heap[0]
+            current = self._posts.get(key)
+            if current is not None and current[1] == -order:
+                if len(self._posts) <= self.count:
+                    break
+                del self._posts[key]
+            heapq.heappop(self._heap)
+
+    # oldest first, as posts are appended
+    def posts(self) -> list[codec.Post]:
+        kept = sorted(self._posts.values(), key=lambda v: (v[0], -v[1]))
+        return [post for _, _, post in kept]
+
+
+def generate_all_feeds(
+    posts: [dict],
+    cache: RenderCache = None,
+    workers: int = None,
+    folder: str = "dist",
+    # e.g. "other." so files of several sources keep apart as release assets
+    prefix: str = "",
+    title: str = "mirror.xyz",
+):
+    os.makedirs(folder, exist_ok=True)
+
+    # each post is rendered at most once for all feeds
+    if cache is None:
+        cache = RenderCache(None)
+    rendered = cache.rendered
+    cache.render_missing(posts, workers)
+
+    filenames = [prefix + opt["filename"] for opt in all_feeds_options]
+    feeds = [_new_feed(filename, title) for filename in filenames]
+    for p in posts:
+        try:
+            full, tiny = cache.get(p)
+            for opt, feed in zip(all_feeds_options, feeds):
+                description = tiny if opt["body_lines"] >= 1 else full
+                feed.add_item(**_entry_to_feed_item(p, opt["mirror_link"], description))
+        except Exception as e:
+            logger.error(f"Failed to add post to feed: {e}")
+    logger.info(f"Rendered {cache.rendered - rendered} new posts of {len(posts)}")
+    cache.save({p["id"] for p in posts if "id" in p})
 
     feed_files = []
-    for opt in all_feeds_options:
-        filename = opt["filename"]
-        path = os.path.join("dist", filename)
+    for filename, feed in zip(filenames, feeds):
+        path = os.path.join(folder, filename)
         feed_files.append(path)
-        feed = generate_feed(
-            posts,
-            filename=filename,
-            mirror_link=opt["mirror_link"],
-            body_lines=opt["body_lines"],
-        )
         with open(path, "w") as f:
             feed.write(f, "utf-8")
 
-    put_github_action_env("FEED_FILES", "\n".join(feed_files))
+    put_github_action_files("FEED_FILES", feed_files)
 
 
-def generate_feed(
-    posts: [dict], filename: str, mirror_link: bool, body_lines: int
-) -> JSONFeed:
+def _new_feed(filename: str, title: str = "mirror.xyz") -> JSONFeed:
     feed_url_base = "https://raw.githubusercontent.com/RoCry/arweave-tracker/deploy"
-    feed = JSONFeed(
-        title="Recent mirror.xyz updates",
+    return JSONFeed(
+        title=f"Recent {title} updates",
         link="https://github.com/arweave-tracker",
         description="Auto generated by arweave-tracker.",
         feed_url=f"{feed_url_base}/{filename}",
         author_name="RoCry",
         author_link="https://github.com/RoCry",
     )
-    for p in posts:
-        try:
-            feed.add_item(**_entry_to_feed_item(p, mirror_link, body_lines))
-        except Exception as e:
-            logger.error(f"Failed to add post to feed: {e}")
-    return feed
 
 
-def _entry_to_feed_item(p: dict, mirror_link: bool, body_lines: int) -> dict:
+# (full html, tiny html) of the body
+def _render_post(p: dict) -> tuple[str, str]:
+    return _render_body(p["body"])
+
+
+def _render_body(body: str) -> tuple[str, str]:
+    if len(body) > MAX_BODY_CHARS:
+        body = body[:MAX_BODY_CHARS]
+    tiny = "\n".join(body.split("\n")[:TINY_BODY_LINES])
+    return markdown.markdown(body), markdown.markdown(tiny)
+
+
+# runs in pool workers
+def _render_chunk(bodies: list[str]) -> list[tuple[str, str]]:
+    return [_render_body(body) for body in bodies]
+
+
+def _entry_to_feed_item(p: dict, mirror_link: bool, description: str) -> dict:
     contributor = p["contributor"]
     digest = p["digest"]
     _id = p["id"]
-    body = p["body"]
-    if body_lines >= 1:
-        body = "\n".join(body.split("\n")[:body_lines])
 
     item = {
         "title": p["title"],
@@ -87,7 +244,7 @@ def _entry_to_feed_item(p: dict, mirror_link: bool, body_lines: int) -> dict:
         if mirror_link
         else f"https://fakemirror.github.io/?id={_id}",
         "unique_id": f"arweave://{_id}",
-        "description": markdown.markdown(body),
+        "description": description,
         "author_name": contributor,
         "author_link": f"https://mirror.xyz/{contributor}",
         "pubdate": datetime.fromtimestamp(int(p["timestamp"])),
@@ -95,3 +252,45 @@ def _entry_to_feed_item(p: dict, mirror_link: bool, body_lines: int) -> dict:
 
     # logger.debug(f"item: {item}")
     return item
+
+
+def test_recent_posts():
+    posts = [
+        {"id": f"t{i}", "digest": f"d{i % 7}", "timestamp": i * 37 % 301}
+        for i in range(300)
+    ]
+    posts += [{"id": "e", "digest": "e", "timestamp": 999, "error": {}}]
+    recent = RecentPosts(5)
+    recent.extend(codec.decode_post(codec.dumps(p)) for p in reversed(posts))
+    newest = {}
+    for p in posts[:-1]:
+        if p["timestamp"] >= newest.get(p["digest"], {"timestamp": -1})["timestamp"]:
+            newest[p["digest"]] = p
+    expected = sorted(newest.values(), key=lambda p: p["timestamp"])[-5:]
+    assert [p.id for p in recent.posts()] == [p["id"] for p in expected]
+    assert recent.min_timestamp == expected[0]["timestamp"]
+    assert len(recent._heap) <= 10
+
+
+def test_render_cache(tmp_path):
+    path = str(tmp_path / "render.json")
+    posts = [{"id": str(i), "body": "# a\nb\nc\nd"} for i in range(3)]
+    cache = RenderCache(path)
+    assert cache.get(posts[0]) == (
+        "<h1>a</h1>\n<p>b\nc\nd</p>",
+        "<h1>a</h1>\n<p>b\nc</p>",
+    )
+    cache.save({"0"})
+
+    cache = RenderCache(path)
+    cache.render_missing(posts)
+    assert cache.rendered == 2
+    more = [{"id": f"m{i}", "body": f"*{i}*"} for i in range(RENDER_CHUNK_SIZE * 2)]
+    big = {"id": "big", "body": "x" * (MAX_BODY_CHARS * 2)}
+    cache.render_missing(more + [big], workers=2)
+    assert cache.get(more[-1])[0] == f"<p><em>{len(more) - 1}</em></p>"
+    assert len(cache.get(big)[0]) < MAX_BODY_CHARS + 10
+    # copies of a post are rendered once, cached posts not at all
+    rendered = cache.rendered
+    cache.render_missing([{"id": "d", "body": "d"}] * 3 + more)
+    assert cache.rendered == rendered + 1
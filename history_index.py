@@ -0,0 +1,294 @@
+import os
+import sqlite3
+from typing import Optional
+
+import codec
+from util import (
+    logger,
+    history_files,
+    parse_shard_name,
+    is_compressed,
+    open_shard,
+    gzip_members,
+)
+
+# bump when the schema changes, the index is rebuilt from shards
+SCHEMA_VERSION = 1
+KINDS = ["transactions", "posts"]
+# index column -> record key, per kind of shard
+RECORD_KEYS = {
+    "transactions": {
+        "height": "block_height",
+        "timestamp": "block_timestamp",
+        "contributor": "contributor",
+        "digest": "original-content-digest",
+    },
+    "posts": {
+        "height": None,
+        "timestamp": "timestamp",
+        "contributor": "contributor",
+        "digest": "digest",
+    },
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS shards (
+  id INTEGER PRIMARY KEY,
+  path TEXT UNIQUE NOT NULL,
+  size INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS records (
+  kind TEXT NOT NULL,
+  id TEXT NOT NULL,
+  height INTEGER,
+  timestamp INTEGER,
+  contributor TEXT,
+  digest TEXT,
+  shard INTEGER NOT NULL,
+  offset INTEGER NOT NULL,
+  line INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS records_id ON records (id);
+CREATE INDEX IF NOT EXISTS records_contributor ON records (contributor);
+CREATE INDEX IF NOT EXISTS records_digest ON records (digest);
+CREATE INDEX IF NOT EXISTS records_height ON records (height);
+CREATE INDEX IF NOT EXISTS records_shard ON records (shard);
+"""
+
+
+# sqlite index of every history record, e.g. cache/history.sqlite,
+# pointing to the shard and byte offset of the line (gzip member and line in it)
+class HistoryIndex(object):
+    def __init__(self, path: str, history_folder: str = "history"):
+        self.path = path
+        self.history_folder = history_folder
+        self._db: Optional[sqlite3.Connection] = None
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        if self._db is None:
+            folder = os.path.dirname(self.path)
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+            # commits run in a worker thread of the pipeline, one at a time
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            if self._db.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+                self._db.executescript(
+                    "DROP TABLE IF EXISTS records; DROP TABLE IF EXISTS shards;"
+                )
+                self._db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            self._db.executescript(SCHEMA)
+        return self._db
+
+    def _shard(self, path: str) -> tuple[Optional[int], int]:
+        row = self.db.execute(
+            "SELECT id, size FROM shards WHERE path = ?", (path,)
+        ).fetchone()
+        return (row[0], row[1]) if row else (None, 0)
+
+    # lines appended to a shard at offset, see ShardIndex.add,
+    # skipped unless the index is up to date with the shard, sync catches up later
+    def add(
+        self,
+        path: str,
+        offset: int,
+        lines: list[bytes],
+        records: list[dict],
+        member_size: int = None,
+    ):
+        parsed = parse_shard_name(path)
+        if parsed is None or parsed[0] not in RECORD_KEYS:
+            return
+        shard, size = self._shard(path)
+        if size != offset:
+            return
+        if shard is None:
+            shard = self.db.execute(
+                "INSERT INTO shards (path, size) VALUES (?, 0)", (path,)
+            ).lastrowid
+        keys = RECORD_KEYS[parsed[0]]
+        rows = []
+        start = offset
+        for i, (line, r) in enumerate(zip(lines, records)):
+            rows.append(
+                (
+                    parsed[0],
+                    r["id"],
+                    r.get(keys["height"]) if keys["height"] else None,
+                    r.get(keys["timestamp"]),
+                    r.get(keys["contributor"]),
+                    r.get(keys["digest"]),
+                    shard,
+                    start if member_size is None else offset,
+                    0 if member_size is None else i,
+                )
+            )
+            start += len(line)
+        self.db.executemany(
+            "INSERT INTO records VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows
+        )
+        end = start if member_size is None else offset + member_size
+        self.db.execute("UPDATE shards SET size = ? WHERE id = ?", (end, shard))
+
+    def commit(self):
+        if self._db is not None:
+            self._db.commit()
+
+    # follow a shard after it is renamed
+    def move(self, path: str, new_path: str):
+        self.db.execute("UPDATE shards SET path = ? WHERE path = ?", (new_path, path))
+        self.commit()
+
+    # forget a shard, e.g. after it is split or rewritten
+    def remove(self, path: str):
+        shard, _ = self._shard(path)
+        if shard is None:
+            return
+        self.db.execute("DELETE FROM records WHERE shard = ?", (shard,))
+        self.db.execute("DELETE FROM shards WHERE id = ?", (shard,))
+        self.commit()
+
+    # index whatever the shards have beyond what is indexed
+    def sync(self):
+        paths = [p for kind in KINDS for p in history_files(self.history_folder, kind)]
+        existing = set(paths)
+        for (path,) in self.db.execute("SELECT path FROM shards").fetchall():
+            if path not in existing:
+                self.remove(path)
+        for path in paths:
+            self._sync_shard(path)
+        self.commit()
+
+    def _sync_shard(self, path: str):
+        _, size = self._shard(path)
+        file_size = os.path.getsize(path)
+        if size > file_size:
+            logger.info(f"Reindexing rewritten shard {path}")
+            self.remove(path)
+            size = 0
+        if size == file_size:
+            return
+        if is_compressed(path):
+            for offset, member_size, data in gzip_members(path, size):
+                lines = data.splitlines(keepends=True)
+                self.add(
+                    path, offset, lines, [codec.loads(l) for l in lines], member_size
+                )
+        else:
+            with open(path, "rb") as f:
+                f.seek(size)
+                while lines := f.readlines(1024 * 1024):
+                    self.add(path, size, lines, [codec.loads(l) for l in lines])
+                    size += sum(len(line) for line in lines)
+
+    def rebuild(self):
+        self.db.executescript("DELETE FROM records; DELETE FROM shards;")
+        self.sync()
+        self.db.execute("VACUUM")
+
+    # (path, offset, line) of matching records, in the order they were indexed,
+    # posts have no height, they match by the height of their transactions
+    def locate(
+        self,
+        kind: str = "transactions",
+        _id: str = None,
+        contributor: str = None,
+        digest: str = None,
+        min_height: int = None,
+        max_height: int = None,
+        min_timestamp: int = None,
+        max_timestamp: int = None,
+        limit: int = 100,
+    ) -> list[tuple[str, int, int]]:
+        conditions, params = ["r.kind = ?"], [kind]
+        for sql, value in [
+            ("r.id = ?", _id),
+            ("r.contributor = ?", contributor),
+            ("r.digest = ?", digest),
+            ("r.timestamp >= ?", min_timestamp),
+            ("r.timestamp <= ?", max_timestamp),
+        ]:
+            if value is not None:
+                conditions.append(sql)
+                params.append(value)
+        heights, height_params = [], []
+        for sql, value in [("height >= ?", min_height), ("height <= ?", max_height)]:
+            if value is not None:
+                heights.append(sql)
+                height_params.append(value)
+        if heights and kind == "transactions":
+            conditions += [f"r.{h}" for h in heights]
+            params += height_params
+        elif heights:
+            conditions.append(
+                "r.id IN (SELECT id FROM records WHERE kind = 'transactions' AND "
+                + " AND ".join(heights)
+                + ")"
+            )
+            params += height_params
+        sql = (
+            "SELECT s.path, r.offset, r.line FROM records r JOIN shards s ON r.shard = s.id"
+            f" WHERE {' AND '.join(conditions)} ORDER BY r.rowid LIMIT ?"
+        )
+        return self.db.execute(sql, params + [limit]).fetchall()
+
+    # matching records read from their shards, see locate
+    def query(self, **kwargs) -> list[dict]:
+        results = []
+        for path, offset, line in self.locate(**kwargs):
+            with open_shard(path, offset) as f:
+                for i, data in enumerate(f):
+                    if i == line:
+                        results.append(codec.loads(data))
+                        break
+        return results
+
+
+def test_history_index(tmp_path):
+    import gzip
+
+    folder = tmp_path / "history"
+    folder.mkdir()
+    txs = [
+        {
+            "id": f"t{i}",
+            "block_height": 100 + i,
+            "block_timestamp": 1000 + i,
+            "contributor": f"c{i % 3}",
+            "original-content-digest": f"d{i // 2}",
+        }
+        for i in range(10)
+    ]
+    plain = str(folder / "transactions_000000000.jsonl")
+    with open(plain, "wb") as f:
+        f.write(b"".join(codec.dumps_line(t) for t in txs[:6]))
+    compressed = str(folder / "posts_000000000.jsonl.gz")
+    posts = [{"id": t["id"], "timestamp": 1, "digest": "p"} for t in txs[4:]]
+    with open(compressed, "wb") as f:
+        f.write(gzip.compress(b"".join(codec.dumps_line(p) for p in posts[:3])))
+        f.write(gzip.compress(b"".join(codec.dumps_line(p) for p in posts[3:])))
+
+    index = HistoryIndex(str(tmp_path / "history.sqlite"), str(folder))
+    index.sync()
+    lines = [codec.dumps_line(t) for t in txs[6:]]
+    index.add(plain, os.path.getsize(plain), lines, txs[6:])
+    with open(plain, "ab") as f:
+        f.write(b"".join(lines))
+    index.commit()
+
+    assert index.query(contributor="c1") == [txs[1], txs[4], txs[7]]
+    assert index.query(digest="d4") == txs[8:]
+    assert [p["id"] for p in index.query(kind="posts", min_height=105)] == [
+        "t5",
+        "t6",
+        "t7",
+        "t8",
+        "t9",
+    ]
+    # appended behind the index's back, e.g. by a run without the cache
+    with open(plain, "ab") as f:
+        f.write(codec.dumps_line({**txs[0], "id": "t10"}))
+    index.sync()
+    assert len(index.query(contributor="c0")) == 5
+    index.rebuild()
+    assert index.query(_id="t9") == [txs[9]]
@@ -0,0 +1,206 @@
+import asyncio
+import functools
+import json
+import math
+import os
+import time
+from contextlib import contextmanager
+
+from util import logger, atomic_write
+
+PREFIX = "arweave_tracker"
+# upper bounds in seconds of histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, math.inf)
+# spans kept in the trace, counters and timers keep counting after that
+MAX_SPANS = 20000
+
+
+def _key(name: str, labels: dict) -> tuple:
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+class _Histogram(object):
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.buckets = [0] * len(BUCKETS)
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.buckets[i] += 1
+                break
+
+    # cumulative counts, as prometheus expects
+    def cumulative(self) -> list[int]:
+        result, total = [], 0
+        for n in self.buckets:
+            total += n
+            result.append(total)
+        return result
+
+
+# counters and timers of a run, exported as a trace and a prometheus snapshot
+class Registry(object):
+    def __init__(self):
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        self.counters: dict[tuple, float] = {}
+        self.histograms: dict[tuple, _Histogram] = {}
+        self.spans: list[dict] = []
+
+    def reset(self):
+        self.__init__()
+
+    def count(self, name: str, value: float = 1, **labels):
+        key = _key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = _key(name, labels)
+        if key not in self.histograms:
+            self.histograms[key] = _Histogram()
+        self.histograms[key].observe(seconds)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            self.observe(name, end - start, **labels)
+            if len(self.spans) < MAX_SPANS:
+                self.spans.append(
+                    {
+                        "name": name,
+                        "start": round(start - self._start, 6),
+                        "duration": round(end - start, 6),
+                        "labels": labels,
+                    }
+                )
+
+    # decorator timing every call, for functions and coroutines
+    def timed(self, name: str):
+        def decorator(fn):
+            if asyncio.iscoroutinefunction(fn):
+
+                @functools.wraps(fn)
+                async def wrapper(*args, **kwargs):
+                    with self.timer(name):
+                        return await fn(*args, **kwargs)
+
+            else:
+
+                @functools.wraps(fn)
+                def wrapper(*args, **kwargs):
+                    with self.timer(name):
+                        return fn(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def trace(self) -> dict:
+        return {
+            "started_at": self.started_at,
+            "duration": round(time.perf_counter() - self._start, 6),
+            "counters": [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in sorted(self.counters.items())
+            ],
+            "timers": [
+                {
+                    "name": name,
+                    "labels": dict(labels),
+                    "count": h.count,
+                    "sum": round(h.sum, 6),
+                    "max": round(h.max, 6),
+                }
+                for (name, labels), h in sorted(self.histograms.items())
+            ],
+            "spans": self.spans,
+        }
+
+    def prometheus(self) -> str:
+        lines = []
+        for name in sorted({name for name, _ in self.counters}):
+            metric = f"{PREFIX}_{name}_total"
+            lines.append(f"# TYPE {metric} counter")
+            for (n, labels), value in sorted(self.counters.items()):
+                if n == name:
+                    lines.append(f"{metric}{_labels(labels)} {_number(value)}")
+        for name in sorted({name for name, _ in self.histograms}):
+            metric = f"{PREFIX}_{name}_seconds"
+            lines.append(f"# TYPE {metric} histogram")
+            for (n, labels), h in sorted(self.histograms.items()):
+                if n != name:
+                    continue
+                for bound, count in zip(BUCKETS, h.cumulative()):
+                    le = "+Inf" if bound == math.inf else str(bound)
+                    lines.append(
+                        f"{metric}_bucket{_labels(labels + (('le', le),))} {count}"
+                    )
+                lines.append(f"{metric}_sum{_labels(labels)} {_number(h.sum)}")
+                lines.append(f"{metric}_count{_labels(labels)} {h.count}")
+        return "\n".join(lines) + "\n"
+
+    # e.g. cache/trace/trace.json and cache/trace/metrics.prom, kept out of the
+    # committed data since every run differs
+    def export(self, folder: str = os.path.join("cache", "trace")) -> list[str]:
+        trace_path = os.path.join(folder, "trace.json")
+        prom_path = os.path.join(folder, "metrics.prom")
+        atomic_write(trace_path, json.dumps(self.trace()))
+        atomic_write(prom_path, self.prometheus())
+        logger.info(f"Exported trace to {trace_path} and {prom_path}")
+        return [trace_path, prom_path]
+
+
+def _labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    escaped = [
+        (k, v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in labels
+    ]
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+def _number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+# the registry of this process
+registry = Registry()
+count = registry.count
+observe = registry.observe
+timer = registry.timer
+timed = registry.timed
+
+
+def test_registry(tmp_path):
+    r = Registry()
+    r.count("content_errors", status=503)
+    r.count("content_errors", status=503)
+    r.count("bytes_written", 10.5, shard='a"b')
+    with r.timer("graphql"):
+        pass
+
+    @r.timed("render")
+    async def render():
+        return 1
+
+    assert asyncio.run(render()) == 1
+    text = r.prometheus()
+    assert 'arweave_tracker_content_errors_total{status="503"} 2' in text
+    assert 'arweave_tracker_bytes_written_total{shard="a\\"b"} 10.5' in text
+    assert 'arweave_tracker_graphql_seconds_bucket{le="+Inf"} 1' in text
+    assert "arweave_tracker_render_seconds_count 1" in text
+
+    paths = r.export(str(tmp_path))
+    with open(paths[0]) as f:
+        assert [s["name"] for s in json.load(f)["spans"]] == ["graphql", "render"]
@@ -1,21 +1,46 @@
-import glob
+import itertools
 import json
+import os
 from datetime import datetime, timezone
 
-import pandas as pd
-import matplotlib.pyplot as plt
+import numpy as np
 
-from util import logger, put_github_action_env
+import codec
+import instrument
+from aggregate import DAY, BucketAggregator
+from columns import ColumnStore
+from rollup import RollupStore
+from shard_index import read_history
+from util import logger, put_github_action_files, history_files, open_shard
+
+# windows read from daily rollups
+ROLLUP_WINDOWS = {"last_7d": 7, "last_30d": 30, "last_90d": 90, "last_365d": 365}
+# chart series name -> metric key
+CHART_SERIES = {"post": "post", "unique_post": "unique_post", "contributor": "user"}
+# transactions parsed from json history per aggregated chunk
+HISTORY_CHUNK_SIZE = 10000
 
 
 class Metric(object):
-    def _recent_history_data_in_days(
+    # exact_distinct=False counts users and unique posts of history windows
+    # with HyperLogLog, in fixed memory per day however long the window
+    def __init__(
         self,
-        key: str,
-        days=7,
-        timestamp_key: str = "block_timestamp",
-        round_to_day=True,
-    ) -> pd.DataFrame:
+        rollup: RollupStore = None,
+        columns: ColumnStore = None,
+        exact_distinct: bool = True,
+        history_folder: str = "history",
+    ):
+        self.rollup = rollup
+        self.columns = columns
+        self.exact_distinct = exact_distinct
+        self.history_folder = history_folder
+
+    def _has_rollup(self) -> bool:
+        return self.rollup is not None and not self.rollup.is_empty()
+
+    @staticmethod
+    def _recent_window(days=7, round_to_day=True) -> tuple[float, float]:
         to_timestamp = (
             (
                 datetime.now()
@@ -25,72 +50,146 @@ class Metric(object):
             if round_to_day
             else datetime.now().timestamp()
         )
+        return to_timestamp - days * 24 * 60 * 60, to_timestamp
 
-        from_timestamp = to_timestamp - days * 24 * 60 * 60
-        all_files = self._recent_history_files(key, -1)
-        all_files.reverse()
-
-        logger.debug(f"{key} loading [{from_timestamp}, {to_timestamp}]")
+    # transactions in [from_timestamp, to_timestamp) grouped into buckets of
+    # `width` seconds from `origin`, read chunk by chunk
+    def _aggregate_history(
+        self,
+        from_timestamp: float,
+        to_timestamp: float,
+        origin: float = 0,
+        width: float = DAY,
+    ) -> BucketAggregator:
+        logger.debug(f"transactions loading [{from_timestamp}, {to_timestamp}]")
+        agg = BucketAggregator(origin, width, exact=self.exact_distinct)
+        if self.columns and self.columns.keys():
+            chunks = self._columns_chunks(from_timestamp, to_timestamp)
+        else:
+            chunks = self._history_chunks(from_timestamp, to_timestamp)
+        rows = 0
+        for chunk in chunks:
+            agg.add(*chunk)
+            rows += len(chunk[0])
+        logger.debug(f"Aggregated {rows} txs into {len(agg.posts)} buckets")
+        return agg
+
+    # (heights, timestamps, contributors, digests) per bucket of memory mapped columns
+    def _columns_chunks(self, from_timestamp: float, to_timestamp: float):
+        # newest buckets first, stop at the first bucket entirely before the window
+        for key in reversed(self.columns.keys()):
+            cols = self.columns.load(
+                key, ["height", "timestamp", "contributor", "digest"]
+            )
+            ts = cols["timestamp"]
+            if len(ts) == 0:
+                continue
+            if ts.max() < from_timestamp:
+                break
+            mask = (ts >= from_timestamp) & (ts < to_timestamp)
+            yield (
+                cols["height"][mask],
+                ts[mask],
+                cols["contributor_values"][cols["contributor"][mask]],
+                cols["digest_values"][cols["digest"][mask]],
+            )
 
-        results = []
-        for path in all_files:
-            with open(path, "r") as f:
-                for line in f:
-                    obj = json.loads(line)
-                    if "error" in obj:
-                        continue
-                    if obj[timestamp_key] >= to_timestamp:
-                        continue
-                    if obj[timestamp_key] < from_timestamp:
-                        # enumerate in DESC order, so we can break all
-                        return pd.DataFrame(results)
-                    results.append(obj)
-        return pd.DataFrame(results)
+    # the same chunks parsed from the json history
+    def _history_chunks(self, from_timestamp: float, to_timestamp: float):
+        # shards out of range are skipped by their index
+        results = (
+            obj
+            for obj in read_history(
+                self.history_folder,
+                "transactions",
+                from_timestamp,
+                to_timestamp,
+                decode=codec.decode_transaction,
+            )
+            if obj.error is None
+        )
+        while chunk := list(itertools.islice(results, HISTORY_CHUNK_SIZE)):
+            yield (
+                np.array([tx.block_height for tx in chunk], dtype=np.int64),
+                np.array([tx.block_timestamp for tx in chunk], dtype=np.int64),
+                np.array([tx.contributor or "" for tx in chunk], dtype=str),
+                np.array([tx.digest or "" for tx in chunk], dtype=str),
+            )
 
     def _recent_history_objects(self, key: str, limit: int):
         results = []
         files = self._recent_history_files(key, limit)
         logger.info(f"{key} loading {len(files)} files")
         for path in files:
-            objs = [json.loads(line) for line in open(path, "r").readlines()]
-            results.extend([o for o in objs if "error" not in o])
+            with open_shard(path) as f:
+                results.extend([o for o in map(codec.loads, f) if "error" not in o])
         logger.info(f"{key} loaded {len(results)} objs")
         return results
 
-    @staticmethod
-    def _recent_history_files(key: str, limit: int):
-        results = sorted(glob.glob(f"./history/{key}_**.jsonl"))
+    def _recent_history_files(self, key: str, limit: int):
+        results = history_files(self.history_folder, key)
         if limit < 0:
             return results
         return results[-limit:]
 
+    @instrument.timed("metric_chart")
     def generate_recent_tx_fig(self, output: str, days=14):
-        df = self._recent_history_data_in_days("transactions", days=days)
-
-        df["datetime"] = pd.to_datetime(df["block_timestamp"], unit="s").round("1d")
-        df["post"] = df["id"]
-        df["unique_post"] = df["original-content-digest"]
-        logger.debug(
-            f"{len(df)} txs: {df.iloc[0]['block_timestamp']} - {df.iloc[-1]['block_timestamp']}"
-        )
-        df = df[["datetime", "post", "unique_post", "contributor"]]
-
-        df = df.groupby("datetime").nunique()
-        logger.debug(f"{len(df)} grouped txs: \n{df.head()}")
-        df.plot(legend=True, figsize=(12, 8))
-        plt.savefig(output)
-        # plt.show()
-
-    def generate_metrics(self, output: str):
-        last_24h_txs = self._recent_history_data_in_days(
-            "transactions", 1, round_to_day=False
-        )
-        if len(last_24h_txs) == 0:
-            logger.warn("No posts found")
+        if self._has_rollup():
+            rows = self._recent_rollup_data_in_days(days)
+        else:
+            rows = self._recent_history_tx_counts_in_days(days)
+        logger.debug(f"{len(rows)} days of txs: {rows[:5]}")
+        labels = [day for day, _ in rows]
+        series = {
+            name: [float(m[key]) for _, m in rows] for name, key in CHART_SERIES.items()
+        }
+        if output.endswith(".png"):
+            import matplotlib.pyplot as plt
+
+            plt.figure(figsize=(12, 8))
+            for name, values in series.items():
+                plt.plot(labels, values, label=name)
+            plt.legend()
+            plt.savefig(output)
+            # plt.show()
             return
-        last_tx = last_24h_txs.iloc[-1]
+        # svg without matplotlib
+        from chart import line_chart_svg
 
-        logger.debug(f"Generating metric from {len(last_24h_txs)} history posts")
+        with open(output, "w") as f:
+            f.write(line_chart_svg(labels, series))
+
+    # [(day, metric)] of complete days from the rollup
+    def _recent_rollup_data_in_days(self, days: int) -> list[tuple[str, dict]]:
+        _, to_timestamp = self._recent_window(days)
+        return self.rollup.daily_metrics(days, to_timestamp)
+
+    # the same days counted from history
+    def _recent_history_tx_counts_in_days(self, days: int) -> list[tuple[str, dict]]:
+        agg = self._aggregate_history(*self._recent_window(days))
+        return [
+            (datetime.fromtimestamp(start, timezone.utc).strftime("%Y-%m-%d"), m)
+            for start, m in agg.series()
+        ]
+
+    @instrument.timed("metric")
+    # chart: the svg next to output by default
+    def generate_metrics(self, output: str, chart: str = None):
+        if self._has_rollup():
+            last_tx = self.rollup.last_tx
+            last_24h = self.rollup.last_hours_metric(24, datetime.now().timestamp())
+        else:
+            from_timestamp, to_timestamp = self._recent_window(1, round_to_day=False)
+            # one bucket spanning the whole window
+            agg = self._aggregate_history(
+                from_timestamp, to_timestamp, origin=from_timestamp, width=DAY
+            )
+            if agg.last_tx is None:
+                logger.warn("No posts found")
+                return
+            last_tx = agg.last_tx
+            last_24h = agg.total()
+            logger.info(f"Generated 24h metric from {last_24h['post']} history txs")
 
         metrics = {
             "updated_at": datetime.now(timezone.utc).astimezone().isoformat(),
@@ -100,38 +199,31 @@ class Metric(object):
             .isoformat(),
         }
 
-        if last_24h := self.last_24h_tx_metric(last_24h_txs):
+        if last_24h:
             metrics["last_24h"] = last_24h
 
+        if self._has_rollup():
+            now = datetime.now().timestamp()
+            for name, days in ROLLUP_WINDOWS.items():
+                if window := self.rollup.last_days_metric(days, now):
+                    metrics[name] = window
+
         logger.debug(f"Metrics: {metrics}")
         with open(output, "w") as f:
             f.write(json.dumps(metrics, ensure_ascii=False, indent=2))
 
-        recent_txs_fig = f"dist/recent_mirror.png"
+        recent_txs_fig = chart or os.path.join(
+            os.path.dirname(output), "recent_mirror.svg"
+        )
         self.generate_recent_tx_fig(recent_txs_fig)
 
-        put_github_action_env("METRIC_FILES", "\n".join([output, recent_txs_fig]))
-
-    @staticmethod
-    def last_24h_tx_metric(df: pd.DataFrame):
-        logger.info(f"Generating 24h metric from {len(df)} history txs")
-        if len(df) == 0:
-            return None
-
-        post_count = len(df)
-        user_count = df["contributor"].nunique()
-        unique_post = df["original-content-digest"].nunique()
-
-        return {
-            "post": post_count,
-            "user": user_count,
-            "unique_post": unique_post,
-        }
+        put_github_action_files("METRIC_FILES", [output, recent_txs_fig])
 
 
 if __name__ == "__main__":
-    pd.set_option("display.max_columns", None)
-
-    m = Metric()
+    m = Metric(
+        rollup=RollupStore.load("cache/rollup.json"),
+        columns=ColumnStore("history/columns"),
+    )
     # m.generate_recent_tx()
     m.generate_metrics("dist/metrics.json")
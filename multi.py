@@ -0,0 +1,164 @@
+import asyncio
+import contextlib
+import json
+import os
+import time
+
+import instrument
+from arweave import ArweaveFetcher
+from cache import ContentCache
+from compact import recover as recover_compaction
+from tracker import Tracker, COMMIT_INTERVAL
+from util import logger, history_lock
+
+
+# trackers of several tag filters in one process, each with its own root folder
+# for checkpoint, rolling files, history and outputs. they share the gateway
+# session, content connections, rate limit and content cache, and take turns
+# a page at a time so a busy source cannot starve the others
+class MultiTracker(object):
+    cache_folder = "cache"
+
+    # sources: [{"name", "tags", "transformer", "root", "posts", "title"}],
+    # the first one usually keeps the default root ""
+    def __init__(
+        self,
+        sources: list[dict],
+        url: str = "https://arweave.net",
+        content_client_options: dict = None,
+        **tracker_options,
+    ):
+        fetcher = None
+        self.trackers: dict[str, Tracker] = {}
+        for source in sources:
+            if fetcher is None:
+                fetcher = ArweaveFetcher(
+                    tags=source["tags"],
+                    url=url,
+                    tags_transformer=source["transformer"],
+                    content_client_options=content_client_options,
+                    cache=ContentCache(os.path.join(self.cache_folder, "content")),
+                )
+            root = source.get("root", source["name"])
+            self.trackers[source["name"]] = Tracker(
+                tags=source["tags"],
+                transformer=source["transformer"],
+                root=root,
+                # caches of other roots stay in the one folder ignored and restored
+                # by the workflow, e.g. cache/sources/other
+                cache_folder=(
+                    os.path.join(self.cache_folder, "sources", source["name"])
+                    if root
+                    else None
+                ),
+                fetcher=fetcher.with_tags(source["tags"], source["transformer"]),
+                fetch_posts=source.get("posts", True),
+                # the default root publishes the files the README links to
+                name=source["name"] if root else None,
+                title=source.get("title"),
+                **tracker_options,
+            )
+        self.fetcher = fetcher
+        self._loop = None
+
+    # sources from a json file, transformers are looked up by name
+    # e.g. [{"name": "mirror", "root": "", "tags": [...], "transformer": "default"}]
+    @classmethod
+    def load(cls, path: str, transformers: dict, **options) -> "MultiTracker":
+        with open(path, "r") as f:
+            sources = json.load(f)
+        for source in sources:
+            source["transformer"] = transformers[source.get("transformer", "default")]
+        return cls(sources, **options)
+
+    def start_tracking(
+        self,
+        keep_tracking: bool = False,
+        keep_recent_count: int = None,
+        generate_feed: bool = True,
+    ):
+        start_time = time.time()
+        logger.info(
+            f"Starting tracking {list(self.trackers)}, keep_tracking: {keep_tracking}"
+        )
+        with contextlib.ExitStack() as locks:
+            for t in self.trackers.values():
+                locks.enter_context(history_lock(t.lock_path))
+                recover_compaction(t.history_folder)
+            self._start_tracking(
+                start_time, keep_tracking, keep_recent_count, generate_feed
+            )
+
+    def _start_tracking(
+        self,
+        start_time: float,
+        keep_tracking: bool,
+        keep_recent_count: int,
+        generate_feed: bool,
+    ):
+        for t in self.trackers.values():
+            t._sync_rollup()
+            t._sync_columns()
+        self._loop = asyncio.new_event_loop()
+        try:
+            self._loop.run_until_complete(
+                self._track(keep_tracking, start_time + COMMIT_INTERVAL)
+            )
+        finally:
+            for t in self.trackers.values():
+                t.writer.close()
+                t.rollup.save()
+            self._loop.run_until_complete(self.fetcher.close())
+            self._loop.close()
+            if self.fetcher.cache:
+                logger.info(f"Content cache: {self.fetcher.cache.stats()}")
+
+        for name, t in self.trackers.items():
+            try:
+                t._publish(keep_recent_count, generate_feed, export_trace=False)
+            except Exception as e:
+                logger.error(f"[{name}] Failed to publish: {e!r}")
+        try:
+            instrument.registry.export(os.path.join(self.cache_folder, "trace"))
+        except Exception as e:
+            logger.error(f"Failed to export trace: {e}")
+
+    # a page of every source with more to fetch per round, concurrently
+    async def _track(self, keep_tracking: bool, deadline: float):
+        active = list(self.trackers.items())
+        while active:
+            results = await asyncio.gather(
+                *[t._run_once_async() for _, t in active], return_exceptions=True
+            )
+            remaining = []
+            for (name, t), result in zip(active, results):
+                if isinstance(result, Exception):
+                    # the others keep going, it starts over next run
+                    instrument.count("source_errors", source=name)
+                    logger.error(f"[{name}] Tracking failed: {result!r}")
+                elif result:
+                    remaining.append((name, t))
+            active = remaining
+            if not keep_tracking or time.time() >= deadline:
+                break
+
+
+def test_multi_tracker(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    sources = [
+        {"name": "a", "root": "", "tags": [], "transformer": None},
+        {"name": "b", "tags": [], "transformer": None, "posts": False},
+    ]
+    m = MultiTracker(sources, content_client_options={"rate_limit": 5})
+    a, b = m.trackers["a"], m.trackers["b"]
+    assert a.checkpoint_path == "checkpoint.json"
+    assert b.history_folder == os.path.join("b", "history")
+    assert a.cache_folder == "cache"
+    # release assets are uploaded by basename
+    assert a._dist_path("metrics.json") == os.path.join("dist", "metrics.json")
+    assert b._dist_path("metrics.json") == os.path.join("b", "dist", "b.metrics.json")
+    assert (a.title, b.title) == ("mirror.xyz", "b")
+    assert b.lock_path == os.path.join("cache", "sources", "b", "history.lock")
+    assert a.fetcher.graphql is b.fetcher.graphql
+    assert a.fetcher.content_client is b.fetcher.content_client
+    assert not b.fetch_posts
@@ -0,0 +1,68 @@
+import time
+from typing import Optional
+
+# arweave targets about 2 minutes per block
+DEFAULT_BLOCK_TIME = 120
+
+
+# how long to wait before the next poll, from the block times we observe
+# through the chain head and whether the last poll found anything new
+class PollScheduler(object):
+    def __init__(
+        self,
+        min_interval: float = 15,
+        max_interval: float = 600,
+        block_time: float = DEFAULT_BLOCK_TIME,
+    ):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        # moving average of seconds per block
+        self.block_time = block_time
+        self.head: Optional[int] = None
+        self.head_at: Optional[float] = None
+        # polls in a row without new transactions or a new block
+        self.idle = 0
+
+    def observe(self, head: int, new_txs: int, now: float = None) -> float:
+        now = time.time() if now is None else now
+        advanced = self.head is not None and head > self.head
+        if advanced:
+            observed = (now - self.head_at) / (head - self.head)
+            # one slow poll must not swing the estimate too far
+            observed = min(max(observed, self.block_time / 4), self.block_time * 4)
+            self.block_time = 0.8 * self.block_time + 0.2 * observed
+        if self.head is None or advanced:
+            self.head, self.head_at = head, now
+
+        if new_txs > 0 or advanced:
+            self.idle = 0
+            # the next block is due one block time after the head moved
+            interval = self.head_at + self.block_time - now
+        else:
+            self.idle += 1
+            interval = self._backoff()
+        return self._clamp(interval)
+
+    # the poll failed, e.g. the gateway is down
+    def failed(self) -> float:
+        self.idle += 1
+        return self._clamp(self._backoff())
+
+    def _backoff(self) -> float:
+        return self.block_time / 2 * 2 ** (self.idle - 1)
+
+    def _clamp(self, interval: float) -> float:
+        return min(max(interval, self.min_interval), self.max_interval)
+
+
+def test_poll_scheduler():
+    s = PollScheduler(min_interval=10, max_interval=600, block_time=120)
+    assert s.observe(100, new_txs=5, now=0) == 120
+    # nothing new, back off from half a block time
+    assert [s.observe(100, 0, now=t) for t in [120, 180, 300]] == [60, 120, 240]
+    assert s.observe(100, 0, now=540) == 480
+    assert s.observe(100, 0, now=1000) == 600
+    # head moved 10 blocks in 1000s, faster than assumed
+    interval = s.observe(110, 0, now=1000)
+    assert s.block_time < 120 and s.idle == 0
+    assert interval == s.block_time
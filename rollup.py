@@ -0,0 +1,250 @@
+import base64
+import hashlib
+import json
+import math
+import os
+import zlib
+from datetime import datetime, timezone
+from typing import Optional
+
+from util import logger, atomic_write
+
+
+# mergeable approximate distinct counter, ~2.3% error with p=11
+class HyperLogLog(object):
+    def __init__(self, p: int = 11, registers: bytearray = None):
+        self.p = p
+        self.m = 1 << p
+        self.registers = registers if registers is not None else bytearray(self.m)
+
+    def add(self, value: str):
+        x = int.from_bytes(
+            hashlib.blake2b(value.encode(), digest_size=8).digest(), "big"
+        )
+        idx = x >> (64 - self.p)
+        rest = x & ((1 << (64 - self.p)) - 1)
+        rank = 64 - self.p - rest.bit_length() + 1
+        if rank > self.registers[idx]:
+            self.registers[idx] = rank
+
+    def merge(self, other: "HyperLogLog") -> "HyperLogLog":
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def count(self) -> int:
+        alpha = 0.7213 / (1 + 1.079 / self.m)
+        estimate = alpha * self.m * self.m / sum(2.0**-r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * self.m and zeros > 0:
+            # linear counting for small cardinalities
+            estimate = self.m * math.log(self.m / zeros)
+        return round(estimate)
+
+    def dumps(self) -> str:
+        return base64.b64encode(zlib.compress(bytes(self.registers))).decode()
+
+    @classmethod
+    def loads(cls, s: str) -> "HyperLogLog":
+        registers = bytearray(zlib.decompress(base64.b64decode(s)))
+        return cls(p=int(math.log2(len(registers))), registers=registers)
+
+
+class _Bucket(object):
+    def __init__(
+        self, post=0, user: HyperLogLog = None, unique_post: HyperLogLog = None
+    ):
+        self.post = post
+        self.user = user or HyperLogLog()
+        self.unique_post = unique_post or HyperLogLog()
+
+    def add(self, tx: dict):
+        self.post += 1
+        if contributor := tx.get("contributor"):
+            self.user.add(contributor)
+        if digest := tx.get("original-content-digest"):
+            self.unique_post.add(digest)
+
+    def merge(self, other: "_Bucket") -> "_Bucket":
+        self.post += other.post
+        self.user.merge(other.user)
+        self.unique_post.merge(other.unique_post)
+        return self
+
+    def metric(self) -> dict:
+        return {
+            "post": self.post,
+            "user": self.user.count(),
+            "unique_post": self.unique_post.count(),
+        }
+
+    def to_dict(self) -> dict:
+        return {
+            "post": self.post,
+            "user": self.user.dumps(),
+            "unique_post": self.unique_post.dumps(),
+        }
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "_Bucket":
+        return cls(
+            d["post"],
+            HyperLogLog.loads(d["user"]),
+            HyperLogLog.loads(d["unique_post"]),
+        )
+
+
+# per day and per hour counters of transactions, updated as they are committed
+class RollupStore(object):
+    # hourly buckets are only needed for the recent windows
+    hours_retention = 48
+
+    def __init__(self, path: str):
+        self.path = path
+        self.days: dict[str, _Bucket] = {}
+        self.hours: dict[str, _Bucket] = {}
+        self.last_tx: Optional[dict] = None
+        # like the checkpoint, so replaying history does not count twice
+        self.block_height: Optional[int] = None
+        self.boundary_ids: set[str] = set()
+        self._dirty = False
+
+    @classmethod
+    def load(cls, path: str) -> "RollupStore":
+        store = cls(path)
+        if not os.path.exists(path):
+            return store
+        try:
+            with open(path, "r") as f:
+                obj = json.load(f)
+        except ValueError as e:
+            logger.warning(f"Ignore broken rollup {path}: {e}")
+            return store
+        store.days = {k: _Bucket.from_dict(v) for k, v in obj["days"].items()}
+        store.hours = {k: _Bucket.from_dict(v) for k, v in obj["hours"].items()}
+        store.last_tx = obj.get("last_tx")
+        store.block_height = obj.get("block_height")
+        store.boundary_ids = set(obj.get("boundary_ids", []))
+        return store
+
+    @staticmethod
+    def _day_key(ts: float) -> str:
+        return datetime.fromtimestamp(ts, timezone.utc).strftime("%Y-%m-%d")
+
+    @staticmethod
+    def _hour_key(ts: float) -> str:
+        return datetime.fromtimestamp(ts, timezone.utc).strftime("%Y-%m-%dT%H")
+
+    def add(self, txs: list[dict]):
+        for tx in txs:
+            height = tx["block_height"]
+            if self.block_height is not None:
+                if height < self.block_height:
+                    continue
+                if height == self.block_height and tx["id"] in self.boundary_ids:
+                    continue
+            if height != self.block_height:
+                self.block_height = height
+                self.boundary_ids = set()
+            self.boundary_ids.add(tx["id"])
+
+            ts = tx["block_timestamp"]
+            self.days.setdefault(self._day_key(ts), _Bucket()).add(tx)
+            self.hours.setdefault(self._hour_key(ts), _Bucket()).add(tx)
+            self.last_tx = {"block_height": height, "block_timestamp": ts}
+            self._dirty = True
+
+    def save(self):
+        if not self._dirty:
+            return
+        if self.last_tx:
+            oldest = self._hour_key(
+                self.last_tx["block_timestamp"] - self.hours_retention * 3600
+            )
+            self.hours = {k: v for k, v in self.hours.items() if k >= oldest}
+        atomic_write(
+            self.path,
+            json.dumps(
+                {
+                    "days": {k: v.to_dict() for k, v in sorted(self.days.items())},
+                    "hours": {k: v.to_dict() for k, v in sorted(self.hours.items())},
+                    "last_tx": self.last_tx,
+                    "block_height": self.block_height,
+                    "boundary_ids": sorted(self.boundary_ids),
+                }
+            ),
+        )
+        self._dirty = False
+
+    def is_empty(self) -> bool:
+        return self.last_tx is None
+
+    # metric of the last `hours` hours up to now, including the current hour
+    def last_hours_metric(self, hours: int, now: float) -> Optional[dict]:
+        keys = {self._hour_key(now - i * 3600) for i in range(hours)}
+        return self._merge_metric([b for k, b in self.hours.items() if k in keys])
+
+    # metric of the last `days` days up to now, including today
+    def last_days_metric(self, days: int, now: float) -> Optional[dict]:
+        keys = {self._day_key(now - i * 86400) for i in range(days)}
+        return self._merge_metric([b for k, b in self.days.items() if k in keys])
+
+    @staticmethod
+    def _merge_metric(buckets: list[_Bucket]) -> Optional[dict]:
+        if len(buckets) == 0:
+            return None
+        merged = _Bucket()
+        for b in buckets:
+            merged.merge(b)
+        return merged.metric()
+
+    # [(day, metric)] of complete days before `to_day`
+    def daily_metrics(self, days: int, to_timestamp: float) -> list[tuple[str, dict]]:
+        to_day = self._day_key(to_timestamp)
+        from_day = self._day_key(to_timestamp - days * 86400)
+        return [
+            (k, b.metric())
+            for k, b in sorted(self.days.items())
+            if from_day <= k < to_day
+        ]
+
+
+def test_hyperloglog():
+    a, b = HyperLogLog(), HyperLogLog()
+    for i in range(5000):
+        a.add(f"a{i}")
+        b.add(f"a{i + 2500}")
+    assert abs(a.count() - 5000) < 5000 * 0.05
+    assert HyperLogLog.loads(a.dumps()).count() == a.count()
+    assert abs(a.merge(b).count() - 7500) < 7500 * 0.05
+
+    small = HyperLogLog()
+    for i in range(10):
+        small.add("x")
+        small.add(f"y{i}")
+    assert small.count() == 11
+
+
+def test_rollup_store(tmp_path):
+    path = str(tmp_path / "rollup.json")
+    store = RollupStore.load(path)
+    txs = [
+        {
+            "id": f"tx{i}",
+            "block_height": 100 + i // 10,
+            "block_timestamp": 1650000000 + i * 600,
+            "contributor": f"c{i % 3}",
+            "original-content-digest": f"d{i // 2}",
+        }
+        for i in range(100)
+    ]
+    store.add(txs[:50])
+    store.save()
+
+    store = RollupStore.load(path)
+    # replaying committed txs must not count twice
+    store.add(txs)
+    now = txs[-1]["block_timestamp"]
+    metric = store.last_hours_metric(24, now)
+    assert metric["post"] == 100 and metric["user"] == 3
+    assert abs(metric["unique_post"] - 50) <= 2
+    assert store.last_hours_metric(1, now)["post"] == 6
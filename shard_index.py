@@ -0,0 +1,291 @@
+import json
+import os
+from typing import Callable, Iterator
+
+import codec
+from util import (
+    logger,
+    atomic_write,
+    history_files,
+    parse_shard_name,
+    is_compressed,
+    open_shard,
+    gzip_members,
+)
+
+# keep an offset every N lines
+INDEX_EVERY = 256
+
+# (height key, timestamp key) of records in each kind of shard
+SHARD_KEYS = {
+    "transactions": ("block_height", "block_timestamp"),
+    "posts": (None, "timestamp"),
+}
+
+
+# sidecar of a history shard: height/time ranges and sparse line offsets,
+# saved next to the shard as <shard>.idx
+class ShardIndex(object):
+    suffix = ".idx"
+
+    def __init__(self, path: str):
+        self.path = path
+        name, _, _ = parse_shard_name(path)
+        self.height_key, self.timestamp_key = SHARD_KEYS.get(name, (None, None))
+
+        # bytes of the shard covered by this index
+        self.size = 0
+        self.count = 0
+        self.min_height = self.max_height = None
+        self.min_timestamp = self.max_timestamp = None
+        # whether timestamps never go backwards, so we can seek and stop early
+        self.timestamp_sorted = True
+        # [line, offset, height, timestamp]
+        self.points: list[list] = []
+        self._dirty = False
+
+    @classmethod
+    def load(cls, path: str) -> "ShardIndex":
+        index = cls(path)
+        try:
+            with open(path + cls.suffix, "r") as f:
+                obj = json.load(f)
+        except (OSError, ValueError):
+            return index
+        for k in [
+            "size",
+            "count",
+            "min_height",
+            "max_height",
+            "min_timestamp",
+            "max_timestamp",
+            "timestamp_sorted",
+            "points",
+        ]:
+            setattr(index, k, obj[k])
+        return index
+
+    # load the sidecar and index whatever was appended since it was saved
+    @classmethod
+    def load_fresh(cls, path: str) -> "ShardIndex":
+        index = cls.load(path)
+        size = os.path.getsize(path)
+        if index.size > size:
+            logger.info(f"Rebuilding stale index of {path}")
+            index = cls(path)
+        if index.size < size:
+            if is_compressed(path):
+                for offset, member_size, data in gzip_members(path, index.size):
+                    lines = data.splitlines(keepends=True)
+                    records = [codec.loads(line) for line in lines]
+                    index.add(offset, lines, records, member_size)
+            else:
+                with open(path, "rb") as f:
+                    f.seek(index.size)
+                    while lines := f.readlines(1024 * 1024):
+                        records = [codec.loads(line) for line in lines]
+                        index.add(index.size, lines, records)
+            index.save()
+        return index
+
+    # member_size: lines are one gzip member of that size written at offset,
+    # points inside it can only seek to the start of the member
+    def add(
+        self,
+        offset: int,
+        lines: list[bytes],
+        records: list[dict],
+        member_size: int = None,
+    ):
+        start = offset
+        for line, record in zip(lines, records):
+            height = record.get(self.height_key) if self.height_key else None
+            timestamp = record.get(self.timestamp_key) if self.timestamp_key else None
+            if self.count % INDEX_EVERY == 0:
+                self.points.append([self.count, offset, height, timestamp])
+            if height is not None:
+                self.min_height = _min(self.min_height, height)
+                self.max_height = _max(self.max_height, height)
+            if timestamp is not None:
+                if self.max_timestamp is not None and timestamp < self.max_timestamp:
+                    self.timestamp_sorted = False
+                self.min_timestamp = _min(self.min_timestamp, timestamp)
+                self.max_timestamp = _max(self.max_timestamp, timestamp)
+            self.count += 1
+            if member_size is None:
+                offset += len(line)
+        self.size = offset if member_size is None else start + member_size
+        self._dirty = True
+
+    def save(self):
+        if not self._dirty:
+            return
+        atomic_write(
+            self.path + self.suffix,
+            json.dumps(
+                {
+                    "size": self.size,
+                    "count": self.count,
+                    "min_height": self.min_height,
+                    "max_height": self.max_height,
+                    "min_timestamp": self.min_timestamp,
+                    "max_timestamp": self.max_timestamp,
+                    "timestamp_sorted": self.timestamp_sorted,
+                    "points": self.points,
+                }
+            ),
+        )
+        self._dirty = False
+
+    # follow the shard after it is renamed
+    def move(self, path: str):
+        old_path = self.path + self.suffix
+        self.path = path
+        self._dirty = True
+        self.save()
+        if os.path.exists(old_path):
+            os.remove(old_path)
+
+    def overlaps(
+        self,
+        from_timestamp: float = None,
+        to_timestamp: float = None,
+        from_height: int = None,
+        to_height: int = None,
+    ) -> bool:
+        if self.count == 0:
+            return False
+        if from_timestamp is not None and self.max_timestamp is not None:
+            if self.max_timestamp < from_timestamp:
+                return False
+        if to_timestamp is not None and self.min_timestamp is not None:
+            if self.min_timestamp >= to_timestamp:
+                return False
+        if from_height is not None and self.max_height is not None:
+            if self.max_height < from_height:
+                return False
+        if to_height is not None and self.min_height is not None:
+            if self.min_height > to_height:
+                return False
+        return True
+
+    # offset of the last indexed line before the given timestamp/height
+    def seek_offset(self, from_timestamp: float = None, from_height: int = None) -> int:
+        offset = 0
+        for _, point_offset, height, timestamp in self.points:
+            if from_height is not None and height is not None:
+                if height >= from_height:
+                    break
+            elif from_timestamp is not None and self.timestamp_sorted:
+                if timestamp is None or timestamp >= from_timestamp:
+                    break
+            else:
+                break
+            offset = point_offset
+        return offset
+
+
+def _min(a, b):
+    return b if a is None else min(a, b)
+
+
+def _max(a, b):
+    return b if a is None else max(a, b)
+
+
+# index keys are attributes of typed records too
+def _field(obj, key: str):
+    return obj.get(key) if isinstance(obj, dict) else getattr(obj, key)
+
+
+# records in [from, to) time range and [from, to] height range,
+# skipping shards by their index and seeking into them
+def read_history(
+    folder: str,
+    name: str,
+    from_timestamp: float = None,
+    to_timestamp: float = None,
+    from_height: int = None,
+    to_height: int = None,
+    # e.g. codec.decode_transaction for typed records
+    decode: Callable = codec.loads,
+) -> Iterator:
+    by_height = from_height is not None or to_height is not None
+    by_timestamp = from_timestamp is not None or to_timestamp is not None
+    for path in history_files(folder, name):
+        index = ShardIndex.load_fresh(path)
+        if not index.overlaps(from_timestamp, to_timestamp, from_height, to_height):
+            continue
+        with open_shard(path, index.seek_offset(from_timestamp, from_height)) as f:
+            for line in f:
+                obj = decode(line)
+                if index.height_key and by_height:
+                    height = _field(obj, index.height_key)
+                    if height is None or (
+                        from_height is not None and height < from_height
+                    ):
+                        continue
+                    if to_height is not None and height > to_height:
+                        break
+                if index.timestamp_key and by_timestamp:
+                    timestamp = _field(obj, index.timestamp_key)
+                    if timestamp is None or (
+                        from_timestamp is not None and timestamp < from_timestamp
+                    ):
+                        continue
+                    if to_timestamp is not None and timestamp >= to_timestamp:
+                        if index.timestamp_sorted:
+                            break
+                        continue
+                yield obj
+
+
+def test_read_history(tmp_path):
+    folder = str(tmp_path)
+    for key in [0, 1000]:
+        path = os.path.join(folder, f"transactions_{key:09d}.jsonl")
+        lines, records = [], []
+        for i in range(1000):
+            record = {"id": key + i, "block_height": key + i, "block_timestamp": i}
+            records.append(record)
+            lines.append((json.dumps(record) + "\n").encode())
+        with open(path, "wb") as f:
+            f.writelines(lines[:500])
+        # index half of the shard when writing, the rest is caught up by readers
+        index = ShardIndex(path)
+        index.add(0, lines[:500], records[:500])
+        index.save()
+        with open(path, "ab") as f:
+            f.writelines(lines[500:])
+
+    ids = [r["id"] for r in read_history(folder, "transactions", 600, 700)]
+    assert ids == list(range(600, 700)) + list(range(1600, 1700))
+    ids = [r["id"] for r in read_history(folder, "transactions", from_height=1990)]
+    assert ids == list(range(1990, 2000))
+
+    index = ShardIndex.load(os.path.join(folder, "transactions_000001000.jsonl"))
+    assert index.count == 1000 and index.max_height == 1999
+    assert index.seek_offset(from_height=1990) > 0
+
+
+def test_read_compressed_history(tmp_path):
+    import gzip
+
+    folder = str(tmp_path)
+    path = os.path.join(folder, "transactions_000000000.jsonl.gz")
+    with open(path, "wb") as f:
+        for start in range(0, 1000, 100):
+            records = [
+                {"id": i, "block_height": i, "block_timestamp": i}
+                for i in range(start, start + 100)
+            ]
+            f.write(
+                gzip.compress(b"".join(json.dumps(r).encode() + b"\n" for r in records))
+            )
+
+    ids = [r["id"] for r in read_history(folder, "transactions", from_height=950)]
+    assert ids == list(range(950, 1000))
+    index = ShardIndex.load(path)
+    assert index.count == 1000 and index.size == os.path.getsize(path)
+    # seeks to the start of the member holding the point
+    assert 0 < index.seek_offset(from_height=950) < index.size
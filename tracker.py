@@ -1,144 +1,743 @@
 import asyncio
-import itertools
+import functools
+import gzip
 import math
-import json
+import signal
+import threading
 import os
 import time
-from typing import Union
+from typing import Union, Optional
 
-from metric import Metric
-from util import logger, read_last_jsonline, chunks
-from arweave import ArweaveFetcher
+import codec
+import instrument
+from util import (
+    logger,
+    offset_of_last_lines,
+    read_lines_reversed,
+    parse_shard_name,
+    history_files,
+    shard_extension,
+    is_compressed,
+    open_shard,
+    history_lock,
+)
+from arweave import ArweaveFetcher, DEFAULT_MIN_BLOCK
+from blobs import BlobStore, BODY_REF_KEY
+from cache import ContentCache
+from checkpoint import Checkpoint
+from columns import ColumnStore
+from compact import (
+    compact_history,
+    recover as recover_compaction,
+    DEFAULT_WORKERS as DEFAULT_COMPACT_WORKERS,
+)
+from history_index import HistoryIndex
+from poll import PollScheduler
+from rollup import RollupStore
+from shard_index import ShardIndex
+from writer import ShardWriter
 
 GITHUB_FILE_LIMIT = 100 * 1024 * 1024  # 100 MB
+# rotate history shards with some headroom
+HISTORY_FILE_LIMIT = GITHUB_FILE_LIMIT * 9 // 10
+COMMIT_INTERVAL = 20 * 60  # commit every 20 min
+ROLLUP_SAVE_INTERVAL = 60
+# bodies longer than this are cut to ROLLING_BODY_LINES in the rolling posts file
+ROLLING_BODY_MAX_LINES = 800
+ROLLING_BODY_LINES = 400
+# posts in feeds, the newest revision of each digest
+FEED_SIZE = 2000
+
+
+# run a method of Tracker holding the lock of its history,
+# finishing a compaction that was interrupted first
+def _holding_history_lock(fn):
+    @functools.wraps(fn)
+    def wrapper(self, *args, **kwargs):
+        with history_lock(self.lock_path):
+            recover_compaction(self.history_folder)
+            return fn(self, *args, **kwargs)
+
+    return wrapper
 
 
 class Tracker(object):
+    # relative to the root folder of the tracker
     history_folder = "history"
+    cache_folder = "cache"
+    dist_folder = "dist"
 
     transactions_path = "transactions.jsonl"
     posts_path = "posts.jsonl"
+    checkpoint_path = "checkpoint.json"
 
     def __init__(
         self,
         tags: list[dict[str, Union[str, list[str]]]],
         transformer,
         history_batch_size: int = 1000,
+        # write new history as gzip members, one per appended batch
+        compress_history: bool = False,
+        # write post bodies to the blob store, records keep a reference
+        blob_bodies: bool = False,
+        url: str = "https://arweave.net",
+        # see ContentClient
+        content_client_options: dict = None,
+        # folder of checkpoint, rolling files, history, cache and dist,
+        # so trackers of other tags can run side by side
+        root: str = "",
+        # e.g. ArweaveFetcher.with_tags, to share connections with other trackers
+        fetcher: ArweaveFetcher = None,
+        # fetch contents of transactions into posts, mirror entries only
+        fetch_posts: bool = True,
+        # local state not committed with the data, "cache" under root by default
+        cache_folder: str = None,
+        # prefix of files published from dist, so files of several sources do not
+        # clash as release assets, None for the default mirror files
+        name: str = None,
+        # of feeds, e.g. "Recent mirror.xyz updates", the name by default
+        title: str = None,
     ):
-        self.fetcher = ArweaveFetcher(tags=tags, tags_transformer=transformer)
+        self.root = root
+        for attr in [
+            "history_folder",
+            "cache_folder",
+            "dist_folder",
+            "transactions_path",
+            "posts_path",
+            "checkpoint_path",
+        ]:
+            setattr(self, attr, os.path.join(root, getattr(Tracker, attr)))
+        if cache_folder is not None:
+            self.cache_folder = cache_folder
+        self.lock_path = os.path.join(self.cache_folder, "history.lock")
+        self.fetcher = fetcher or ArweaveFetcher(
+            tags=tags,
+            url=url,
+            tags_transformer=transformer,
+            content_client_options=content_client_options,
+            cache=ContentCache(os.path.join(self.cache_folder, "content")),
+        )
+        self.fetch_posts = fetch_posts
+        self.name = name
+        self.title = title or name or "mirror.xyz"
         self.history_batch_size = history_batch_size
+        self.compress_history = compress_history
+        self.blob_bodies = blob_bodies
+        # also read when disabled, records written with it on still refer to it
+        self.blobs = BlobStore(os.path.join(self.history_folder, "blobs"))
         os.makedirs(self.history_folder, exist_ok=True)
-        self.cursor = None
-        self.batch_size = 100
-        self.last_tx = read_last_jsonline(self.transactions_path)
+        # edges per page, None to let the fetcher adapt it to the gateway
+        self.batch_size = None
+        self.checkpoint = Checkpoint.load(
+            self.checkpoint_path, transactions_path=self.transactions_path
+        )
+        self.writer = ShardWriter(
+            max_bytes=HISTORY_FILE_LIMIT, on_rotate=self._on_shard_rotated
+        )
+        # sidecar indexes of history shards written in this run
+        self._shard_indexes: dict[str, ShardIndex] = {}
+        self.rollup = RollupStore.load(os.path.join(self.cache_folder, "rollup.json"))
+        self._rollup_saved_at = time.time()
+        self.columns = ColumnStore(os.path.join(self.history_folder, "columns"))
+        self.index = HistoryIndex(
+            os.path.join(self.cache_folder, "history.sqlite"), self.history_folder
+        )
+        # one event loop for the whole run, keep connections alive between pages
+        self._loop = None
 
+    @_holding_history_lock
     def start_tracking(
         self,
         keep_tracking: bool = False,
         keep_recent_count: int = None,
         generate_feed: bool = True,
+        pipeline: bool = False,
     ):
         start_time = time.time()
-        logger.info(f"Starting tracking keep_tracking: {keep_tracking}")
-        while self._run_once():
-            if not keep_tracking:
-                break
-            if time.time() - start_time >= 1200:
-                # commit every 20 min
-                break
+        logger.info(
+            f"Starting tracking keep_tracking: {keep_tracking}, pipeline: {pipeline}"
+        )
+        self._sync_rollup()
+        self._sync_columns()
+        try:
+            if pipeline:
+                self._run_async(
+                    self._run_pipeline(
+                        keep_tracking=keep_tracking,
+                        deadline=start_time + COMMIT_INTERVAL,
+                    )
+                )
+            else:
+                while self._run_once():
+                    if not keep_tracking:
+                        break
+                    if time.time() - start_time >= COMMIT_INTERVAL:
+                        break
+        finally:
+            self.writer.close()
+            self.rollup.save()
+            self._run_async(self.fetcher.close())
+            if self.fetcher.cache:
+                logger.info(f"Content cache: {self.fetcher.cache.stats()}")
+
+        self._publish(keep_recent_count, generate_feed)
+
+    # keep one process polling as new blocks arrive, with pools and caches kept alive,
+    # feeds and metrics are published every publish_interval seconds
+    @_holding_history_lock
+    def daemon(
+        self,
+        keep_recent_count: int = None,
+        generate_feed: bool = True,
+        publish_interval: float = 30 * 60,
+        min_interval: float = 15,
+        max_interval: float = 600,
+        # seconds, None to run until SIGTERM/SIGINT
+        max_runtime: float = None,
+    ):
+        logger.info(
+            f"Starting daemon publish_interval: {publish_interval}, max_runtime: {max_runtime}"
+        )
+        stop = threading.Event()
+        handlers = _stop_on_signals(stop)
+        scheduler = PollScheduler(min_interval, max_interval)
+        self._sync_rollup()
+        self._sync_columns()
+        start_time = published_at = time.time()
+        try:
+            while not stop.is_set():
+                try:
+                    before = self.checkpoint.stats["transactions"]
+                    # no pause while there are more pages
+                    while self._run_once() and not stop.is_set():
+                        pass
+                    new_txs = self.checkpoint.stats["transactions"] - before
+                    head = self._run_async(self.fetcher.current_block_height_async())
+                    interval = scheduler.observe(head, new_txs)
+                    logger.info(
+                        f"Polled {new_txs} transactions, head: {head}, block time: {scheduler.block_time:.0f}s, next poll in {interval:.0f}s"
+                    )
+                except Exception as e:
+                    instrument.count("poll_errors")
+                    interval = scheduler.failed()
+                    logger.error(f"Poll failed, retry in {interval:.0f}s: {e!r}")
+
+                if time.time() - published_at >= publish_interval:
+                    try:
+                        self._publish(keep_recent_count, generate_feed)
+                    except Exception as e:
+                        logger.error(f"Failed to publish: {e!r}")
+                    published_at = time.time()
+                if max_runtime and time.time() - start_time + interval > max_runtime:
+                    break
+                stop.wait(interval)
+        finally:
+            for sig, handler in handlers.items():
+                signal.signal(sig, handler)
+            self.writer.close()
+            self.rollup.save()
+            self._run_async(self.fetcher.close())
+        self._publish(keep_recent_count, generate_feed)
+
+    # rolling files, feeds, metrics and the trace from what is tracked so far
+    # export_trace: False when the trace is exported for several trackers at once
+    def _publish(
+        self,
+        keep_recent_count: int = None,
+        generate_feed: bool = True,
+        export_trace: bool = True,
+    ):
+        # truncate replaces rolling files, the writer reopens them afterwards
+        self.writer.close()
+        self.rollup.save()
 
         if keep_recent_count:
             self.truncate(line_count=keep_recent_count)
 
-        if generate_feed:
+        if generate_feed and self.fetch_posts:
             self.generate_feed()
 
         # allow metrics fail
         try:
-            m = Metric()
-            m.generate_metrics("dist/metrics.json")
+            from metric import Metric
+
+            os.makedirs(self.dist_folder, exist_ok=True)
+            m = Metric(
+                rollup=self.rollup,
+                columns=self.columns,
+                history_folder=self.history_folder,
+            )
+            m.generate_metrics(
+                self._dist_path("metrics.json"),
+                chart=os.path.join(
+                    self.dist_folder, f"recent_{self.name or 'mirror'}.svg"
+                ),
+            )
         except Exception as e:
             logger.error(f"Failed to generate metric: {e}")
 
         self.split_large_history_files_if_needed()
 
+        if not export_trace:
+            return
+        try:
+            instrument.registry.export(os.path.join(self.cache_folder, "trace"))
+        except Exception as e:
+            logger.error(f"Failed to export trace: {e}")
+
+    # e.g. dist/metrics.json, or sources/other/dist/other.metrics.json
+    def _dist_path(self, filename: str) -> str:
+        if self.name:
+            filename = f"{self.name}.{filename}"
+        return os.path.join(self.dist_folder, filename)
+
     def _run_once(self):
-        limit = self.batch_size
+        return self._run_async(self._run_once_async())
 
-        min_block = self.last_tx["block_height"] if self.last_tx else None
+    async def _run_once_async(self):
+        limit = self.batch_size
 
-        txs, has_next, cursor = self.fetcher.fetch_transactions(
-            cursor=self.cursor, min_block=min_block, limit=limit
+        query_cursor, min_block = self.checkpoint.query()
+        txs, has_next, cursor = await self.fetcher.fetch_transactions_async(
+            cursor=query_cursor, min_block=min_block, limit=limit
         )
 
         logger.info(
-            f"Fetched {len(txs)} transactions, has_next: {has_next}, cursor: {cursor}, last_tx: {self.last_tx}"
+            f"Fetched {len(txs)} transactions, has_next: {has_next}, cursor: {cursor}, block_height: {self.checkpoint.block_height}"
         )
         if len(txs) == 0:
             return False
 
-        # trim duplicated txs when
-        # no cursor -> fetch by block height, which will have duplicated txs
-        if self.last_tx is not None and self.cursor is None:
-            txs = list(
-                itertools.dropwhile(lambda t: t["id"] != self.last_tx["id"], txs)
-            )
-            if len(txs) <= 1:
-                logger.info(f"No new transactions, cursor: {cursor}")
-                # all txs are duplicated, try again with new cursor
-                self.cursor = cursor
-                return True
-            txs = txs[1:]
-
-        group_by_keys_txs = {}
-        for tx in txs:
+        txs = self._filter_seen(txs)
+        if len(txs) == 0:
+            logger.info(f"No new transactions, cursor: {cursor}")
+            # all txs are duplicated, try again with new cursor
+            self._commit({}, {}, cursor, min_block)
+            return True
+
+        group_by_keys_txs = self._group_by_key(txs)
+
+        group_by_keys_posts = await self._fetch_posts(group_by_keys_txs)
+
+        # save after success
+        self._commit(group_by_keys_txs, group_by_keys_posts, cursor, min_block)
+
+        return has_next
+
+    async def _fetch_posts(self, group_by_keys_txs: dict) -> dict:
+        keys = list(group_by_keys_txs.keys())
+        results = await asyncio.gather(
+            *[self._fetch_contents(group_by_keys_txs[k]) for k in keys]
+        )
+        for key, posts in zip(keys, results):
+            logger.info(f"{key} Fetched {len(posts)} posts")
+        return dict(zip(keys, results))
+
+    def _run_async(self, coro):
+        if self._loop is None or self._loop.is_closed():
+            self._loop = asyncio.new_event_loop()
+        return self._loop.run_until_complete(coro)
+
+    # fetch pages, fetch contents and write files in separate stages,
+    # so the next page is requested while the current one is still downloading
+    async def _run_pipeline(
+        self, keep_tracking: bool, deadline: float, queue_size: int = 4
+    ):
+        pages = asyncio.Queue(maxsize=queue_size)
+        batches = asyncio.Queue(maxsize=queue_size)
+
+        async def produce_pages():
+            cursor, min_block = self.checkpoint.query()
+            try:
+                while True:
+                    page = await self.fetcher.fetch_transactions_async(
+                        cursor=cursor, min_block=min_block, limit=self.batch_size
+                    )
+                    txs, has_next, next_cursor = page
+                    logger.info(
+                        f"Fetched {len(txs)} transactions, has_next: {has_next}, cursor: {next_cursor}"
+                    )
+                    if len(txs) == 0:
+                        break
+                    txs = self._filter_seen(txs)
+                    cursor = next_cursor
+                    await pages.put((txs, cursor, min_block))
+                    if not has_next or not keep_tracking or time.time() >= deadline:
+                        break
+            finally:
+                await pages.put(None)
+
+        async def fetch_contents():
+            try:
+                while (page := await pages.get()) is not None:
+                    txs, cursor, min_block = page
+                    posts = await self._fetch_contents(txs)
+                    logger.info(f"Fetched {len(posts)} posts")
+                    await batches.put(
+                        (
+                            self._group_by_key(txs),
+                            self._group_by_key(posts, txs),
+                            cursor,
+                            min_block,
+                        )
+                    )
+            finally:
+                await batches.put(None)
+
+        async def write_batches():
+            while (batch := await batches.get()) is not None:
+                await asyncio.to_thread(self._commit, *batch)
+
+        await _gather_or_cancel(produce_pages(), fetch_contents(), write_batches())
+
+    async def _fetch_contents(self, txs: list[dict]) -> list[dict]:
+        ids = [tx["id"] for tx in txs]
+        # taken either way, the fetcher keeps them until then
+        digests = self.fetcher.take_content_digests(ids)
+        if not self.fetch_posts:
+            return []
+        return await self.fetcher.batch_fetch_data(ids, digests)
+
+    # no cursor -> fetch by block height, which will have duplicated txs
+    def _filter_seen(self, txs: list[dict]) -> list[dict]:
+        return [tx for tx in txs if not self.checkpoint.is_seen(tx)]
+
+    # group items by the history bucket of their transactions
+    def _group_by_key(self, items: list[dict], txs: list[dict] = None) -> dict:
+        result = {}
+        for item, tx in zip(items, txs or items):
             key = (
                 tx["block_height"] // self.history_batch_size * self.history_batch_size
             )
-            group_by_keys_txs.setdefault(key, []).append(tx)
+            result.setdefault(key, []).append(item)
+        return result
 
-        group_by_keys_posts = {}
-        for key, txs in group_by_keys_txs.items():
-            ids = [tx["id"] for tx in txs]
-            posts = asyncio.run(self.fetcher.batch_fetch_data(ids))
-            logger.info(f"{key} Fetched {len(posts)} posts")
-            group_by_keys_posts[key] = posts
+    # append files, then move the checkpoint past them
+    @instrument.timed("commit")
+    def _commit(
+        self,
+        group_by_keys_txs: dict,
+        group_by_keys_posts: dict,
+        cursor: Optional[str],
+        min_block: Optional[int] = None,
+    ):
+        self._append_groups(group_by_keys_txs, group_by_keys_posts)
+        # data must be in files before the checkpoint moves past it
+        self.writer.flush()
+        self._save_shard_indexes()
+        self.index.commit()
+        self.checkpoint.advance(
+            [tx for txs in group_by_keys_txs.values() for tx in txs],
+            cursor,
+            [p for posts in group_by_keys_posts.values() for p in posts],
+            min_block,
+        )
+        self.checkpoint.save()
+        # the rollup catches up from history if it is behind, no need to save every batch
+        if time.time() - self._rollup_saved_at >= ROLLUP_SAVE_INTERVAL:
+            self.rollup.save()
+            self._rollup_saved_at = time.time()
 
-        # save after success
-        self.cursor = cursor
+    def _append_groups(self, group_by_keys_txs: dict, group_by_keys_posts: dict):
         for key, txs in group_by_keys_txs.items():
             self.append_to_file(key, self.transactions_path, txs)
+            self.rollup.add(txs)
+            self.columns.append(self.writer, key, txs)
         for key, posts in group_by_keys_posts.items():
             self.append_to_file(key, self.posts_path, posts)
 
-        return has_next
+    # rebuild history by paging block sub ranges concurrently,
+    # each range is spooled to disk and merged into history files in height order
+    @_holding_history_lock
+    def backfill(self, from_block: int = None, to_block: int = None, workers: int = 4):
+        # continue from the checkpoint, the first range overlaps with what we have
+        resume = from_block is None and self.checkpoint.block_height is not None
+        if from_block is None:
+            from_block = self.checkpoint.block_height or DEFAULT_MIN_BLOCK
+        if to_block is None:
+            to_block = self._run_async(self.fetcher.current_block_height_async())
+        self._sync_rollup()
+        self._sync_columns()
+        # more ranges than workers, activity is not even across heights
+        ranges = self._split_block_range(from_block, to_block, workers * 4)
+        logger.info(
+            f"Backfilling [{from_block}, {to_block}] in {len(ranges)} ranges with {workers} workers"
+        )
+        try:
+            self._run_async(self._backfill(ranges, workers, resume))
+        finally:
+            self.writer.close()
+            self.rollup.save()
+            self._run_async(self.fetcher.close())
+
+    @staticmethod
+    def _split_block_range(from_block: int, to_block: int, count: int):
+        step = max(1, math.ceil((to_block - from_block + 1) / count))
+        return [
+            (lo, min(lo + step - 1, to_block))
+            for lo in range(from_block, to_block + 1, step)
+        ]
+
+    # workers: ranges paged together in one request
+    async def _backfill(
+        self,
+        ranges: list[tuple[int, int]],
+        workers: int,
+        resume: bool = False,
+        queue_size: int = 4,
+    ):
+        spool_folder = os.path.join(self.cache_folder, "backfill")
+        os.makedirs(spool_folder, exist_ok=True)
+        spool_paths = [
+            os.path.join(spool_folder, f"{i}.jsonl") for i in range(len(ranges))
+        ]
+        done = [asyncio.Event() for _ in ranges]
+        # pages of each range waiting for their contents, None once it is paged
+        pages = [asyncio.Queue(maxsize=queue_size) for _ in ranges]
+
+        async def page_ranges():
+            cursors = [None] * len(ranges)
+            active = list(range(len(ranges)))
+            while active:
+                # the next page of the oldest ranges, in one aliased request
+                batch = active[:workers]
+                results = await self.fetcher.fetch_ranges_async(
+                    [(cursors[i], *ranges[i]) for i in batch], limit=self.batch_size
+                )
+                for i, (txs, has_next, next_cursor) in zip(batch, results):
+                    if resume and i == 0:
+                        # the first range overlaps with what we have
+                        txs = self._filter_seen(txs)
+                    cursors[i] = next_cursor
+                    if len(txs) > 0:
+                        await pages[i].put(txs)
+                    if not has_next or next_cursor is None:
+                        await pages[i].put(None)
+                        active.remove(i)
+
+        async def spool(i: int):
+            await self._spool_range(*ranges[i], pages[i], spool_paths[i])
+            done[i].set()
+
+        async def merge():
+            for i in range(len(ranges)):
+                await done[i].wait()
+                await asyncio.to_thread(self._merge_spool, spool_paths[i])
+
+        await _gather_or_cancel(
+            page_ranges(), *[spool(i) for i in range(len(ranges))], merge()
+        )
+
+    # fetch contents of the pages of a range into its spool file
+    async def _spool_range(
+        self, min_block: int, max_block: int, pages: asyncio.Queue, spool_path: str
+    ):
+        count = 0
+        with open(spool_path, "wb") as f:
+            while (txs := await pages.get()) is not None:
+                posts = await self._fetch_contents(txs)
+                f.write(codec.dumps_line({"txs": txs, "posts": posts}))
+                count += len(txs)
+        logger.info(f"Backfilled [{min_block}, {max_block}] {count} transactions")
+
+    def _merge_spool(self, spool_path: str):
+        with open(spool_path, "rb") as f:
+            for line in f:
+                page = codec.loads(line)
+                txs = page["txs"]
+                # range cursors are meaningless outside the range, resume by height
+                self._commit(
+                    self._group_by_key(txs),
+                    self._group_by_key(page["posts"], txs),
+                    cursor=None,
+                )
+        os.remove(spool_path)
+
+    # replay committed transactions the rollup has not seen, e.g. after a crash or cache miss
+    def _sync_rollup(self):
+        height = self.checkpoint.block_height
+        if height is None:
+            return
+        if self.rollup.block_height is not None and (
+            self.rollup.block_height > height
+            or (
+                self.rollup.block_height == height
+                and self.checkpoint.boundary_ids <= self.rollup.boundary_ids
+            )
+        ):
+            return
+        from_height = self.rollup.block_height or 0
+        logger.info(f"Syncing rollup from history, block height {from_height}")
+        for path in history_files(self.history_folder, "transactions"):
+            _, key, _ = parse_shard_name(path)
+            if key + self.history_batch_size <= from_height:
+                continue
+            with open_shard(path) as f:
+                self.rollup.add(
+                    [
+                        tx
+                        for tx in map(codec.loads, f)
+                        if tx["block_height"] >= from_height
+                    ]
+                )
+        self.rollup.save()
+
+    def rebuild_rollup(self):
+        self.rollup = RollupStore(self.rollup.path)
+        self._sync_rollup()
+
+    # rebuild columns of buckets whose row count does not match history,
+    # e.g. history written before columns existed or a crash between flushes
+    def _sync_columns(self, force: bool = False):
+        # no stale handles of column files about to be removed
+        self.writer.close()
+        shards = {}
+        for path in history_files(self.history_folder, "transactions"):
+            _, key, _ = parse_shard_name(path)
+            shards.setdefault(key, []).append(path)
+        for key in self.columns.keys():
+            if key not in shards:
+                self.columns.remove(key)
+        for key, paths in shards.items():
+            count = sum(ShardIndex.load_fresh(p).count for p in paths)
+            if not force and self.columns.row_count(key) == count:
+                continue
+            logger.info(f"Rebuilding columns of {key} from {len(paths)} files")
+            self.columns.remove(key)
+            for path in paths:
+                with open_shard(path) as f:
+                    while lines := f.readlines(1024 * 1024):
+                        self.columns.append(
+                            self.writer, key, [codec.loads(line) for line in lines]
+                        )
+            self.writer.flush()
+
+    def rebuild_columns(self):
+        self._sync_columns(force=True)
+        self.writer.close()
 
     # make sure no files larger than 100MB(GitHub limit)
+    # NOTE: shards are rotated when appending, this is only for files written by old versions
+    @instrument.timed("split")
     def split_large_history_files_if_needed(self):
         for p in os.listdir(self.history_folder):
             path = os.path.join(self.history_folder, p)
-            size = os.path.getsize(path)
-            if size >= GITHUB_FILE_LIMIT:
-                # NOTE: this is a hack to split large history files
-                # x2 to make sure we split to smaller files
-                parts = math.ceil(size / GITHUB_FILE_LIMIT) * 2
-                self._split_file(path, parts)
+            if not os.path.isfile(path) or parse_shard_name(path) is None:
+                continue
+            if os.path.getsize(path) >= GITHUB_FILE_LIMIT:
+                # NOTE: half of the limit, so parts are far from the limit
+                self._split_file(path, GITHUB_FILE_LIMIT // 2)
+                # parts are indexed again when they are next read
+                self._shard_indexes.pop(path, None)
+                self.index.remove(path)
 
+    # split in one forward pass, start a new part before it grows over max_bytes,
+    # compressed shards are re-framed into members of about 1MB of lines
     @staticmethod
-    def _split_file(path: str, chunk_count: int):
-        logger.info(f"Splitting file {path} to {chunk_count} parts")
-        with open(path, "r") as f:
-            total_lines = f.readlines()
-        chunk_size = math.ceil(len(total_lines) / chunk_count)
-        comps = path.split(".")
+    def _split_file(path: str, max_bytes: int):
+        logger.info(f"Splitting file {path} to parts of {max_bytes} bytes")
+        folder = os.path.dirname(path)
+        name, key, _ = parse_shard_name(path)
+        compressed = is_compressed(path)
+        ext = shard_extension(path) if compressed else "jsonl"
         offset = 1
-        while os.path.exists(".".join(comps[:-1]) + f".{offset}.json"):
-            offset += 1
-        for i, lines in enumerate(chunks(total_lines, chunk_size)):
-            new_path = ".".join(comps[:-1]) + f".{i + offset}.json"
-            with open(new_path, "a") as f:  # append to file
-                f.writelines(lines)
+        for p in history_files(folder, name):
+            _, k, part = parse_shard_name(p)
+            if k == key and part is not None:
+                offset = max(offset, part + 1)
+
+        def part_path(i: int) -> str:
+            return os.path.join(folder, f"{name}_{key:09d}.{offset + i}.{ext}")
+
+        count = 0
+        size = 0
+        out = None
+
+        def write(data: bytes):
+            nonlocal count, size, out
+            if out is None or (size > 0 and size + len(data) > max_bytes):
+                if out is not None:
+                    out.close()
+                out = open(part_path(count) + ".tmp", "wb")
+                count += 1
+                size = 0
+            out.write(data)
+            size += len(data)
+
+        try:
+            with open_shard(path) as f:
+                if compressed:
+                    while lines := f.readlines(1024 * 1024):
+                        write(gzip.compress(b"".join(lines)))
+                else:
+                    for line in f:
+                        write(line)
+        finally:
+            if out is not None:
+                out.close()
+
+        for i in range(count):
+            os.replace(part_path(i) + ".tmp", part_path(i))
         os.remove(path)
+        # parts are indexed again when they are read
+        if os.path.exists(path + ShardIndex.suffix):
+            os.remove(path + ShardIndex.suffix)
+        logger.info(f"Split {path} to {count} parts")
+
+    # records of history matching every given filter, read from their shards
+    # e.g. python . query --contributor 0x... or python . query posts --digest ...
+    def query(
+        self,
+        kind: str = "transactions",
+        tx_id: str = None,
+        contributor: str = None,
+        digest: str = None,
+        min_height: int = None,
+        max_height: int = None,
+        min_timestamp: int = None,
+        max_timestamp: int = None,
+        limit: int = 100,
+    ) -> list[dict]:
+        # catch up with shards written by runs without this cache
+        self.index.sync()
+        return self.index.query(
+            kind=kind,
+            _id=tx_id,
+            contributor=contributor,
+            digest=digest,
+            min_height=min_height,
+            max_height=max_height,
+            min_timestamp=min_timestamp,
+            max_timestamp=max_timestamp,
+            limit=limit,
+        )
+
+    def rebuild_index(self):
+        self.writer.close()
+        self.index.rebuild()
+
+    # drop duplicate records, sort by block height and re-split history shards,
+    # buckets in parallel in a process pool, e.g. python . compact --workers 4
+    @_holding_history_lock
+    def compact(self, workers: int = DEFAULT_COMPACT_WORKERS) -> dict:
+        self.writer.close()
+        report = compact_history(
+            self.history_folder, HISTORY_FILE_LIMIT, self.compress_history, workers
+        )
+        for path in report["rewritten"]:
+            self.index.remove(path)
+            kind, key, _ = parse_shard_name(path)
+            if kind == "transactions":
+                self.columns.remove(key)
+        self._sync_columns()
+        self.writer.close()
+        if report["duplicates"]:
+            self.rebuild_rollup()
+        logger.info(
+            f"Compacted {report['buckets']} buckets, reclaimed {report['reclaimed_records']} records and {report['reclaimed_bytes']} bytes"
+        )
+        return report
 
     def truncate(self, interval: int = None, line_count: int = None):
         self._truncate(self.transactions_path, "block_timestamp", interval, line_count)
@@ -148,63 +747,388 @@ class Tracker(object):
     def _truncate(path: str, timestamp_key: str, interval: int, line_count: int):
         if interval is None and line_count is None:
             return
+        if not os.path.exists(path):
+            return
 
         logger.info(
             f"Truncating {path} with interval: {interval}, line_count: {line_count}"
         )
 
-        with open(path, "r") as f:
-            lines = f.readlines()
-
+        offset = 0
         if line_count is not None:
-            if len(lines) <= line_count and interval is None:
+            offset = offset_of_last_lines(path, line_count)
+            if offset == 0 and interval is None:
                 return
-            lines = lines[-line_count:]
 
         # NOTE: truncate by time will cause transactions not match posts since they have different timestamp
         start_time = time.time() - interval if interval else None
-        with open(path, "w") as f:
-            for line in lines:
+        tmp_path = path + ".tmp"
+        with open(path, "rb") as f, open(tmp_path, "wb") as out:
+            f.seek(offset)
+            for line in f:
                 if start_time is not None:
-                    obj = json.loads(line)
+                    obj = codec.loads(line)
                     if obj[timestamp_key] < start_time:
                         continue
                     # post is not ordered in same block, so we simply check every post
                     # start_time = None
-                f.write(line)
+                out.write(line)
+        os.replace(tmp_path, path)
 
-    def generate_feed(self):
-        from feed import generate_all_feeds
+    # the newest count posts of the rolling file, read from its end,
+    # or of every history shard, e.g. python . generate_feed --from_history
+    @instrument.timed("feed")
+    def generate_feed(self, count: int = FEED_SIZE, from_history: bool = False):
+        from feed import generate_all_feeds, RenderCache, RecentPosts
 
-        with open(self.posts_path, "r") as f:
-            posts = [json.loads(line) for line in f.readlines()]
-            posts = list(filter(lambda p: "error" not in p, posts))
-            generate_all_feeds(posts)
+        recent = RecentPosts(count)
+        if from_history:
+            for path in reversed(history_files(self.history_folder, "posts")):
+                index = ShardIndex.load_fresh(path)
+                # nothing newer than the posts kept so far
+                if (min_timestamp := recent.min_timestamp) is not None:
+                    if not index.overlaps(from_timestamp=min_timestamp):
+                        continue
+                with open_shard(path) as f:
+                    recent.extend(map(codec.decode_post, f))
+        else:
+            recent.extend(map(codec.decode_post, read_lines_reversed(self.posts_path)))
+        posts = [codec.asdict(p) for p in recent.posts()]
+        cache = RenderCache(os.path.join(self.cache_folder, "feed", "render.json"))
+        # read bodies of posts not rendered yet
+        for i, p in enumerate(posts):
+            if p.get("id") in cache.entries:
+                continue
+            if BODY_REF_KEY in p:
+                p = self.blobs.attach(p)
+            if "body" in p:
+                # history has full bodies
+                posts[i] = {**p, "body": self._rolling_body(p["body"])}
+        generate_all_feeds(
+            posts,
+            cache=cache,
+            folder=self.dist_folder,
+            prefix=f"{self.name}." if self.name else "",
+            title=self.title,
+        )
 
     # json lines
     # append to current files and history files
+    @instrument.timed("append")
     def append_to_file(self, key: int, path: str, dicts: list[dict]):
         logger.info(f"{key} Appending {len(dicts)} to {path}")
 
-        parts = path.split(".")
+        parts = os.path.basename(path).split(".")
         name = ".".join(parts[:-1])
         ext = parts[-1]
+        if self.compress_history:
+            ext += ".gz"
+        history_path = os.path.join(self.history_folder, f"{name}_{key:09d}.{ext}")
 
-        with open(path, "a") as f, open(
-            os.path.join(self.history_folder, f"{name}_{key:09d}.{ext}"), "a"
-        ) as hf:
-            for d in dicts:
-                s = json.dumps(d, ensure_ascii=False)
-                hf.write(s + "\n")
-
-                # truncate body if needed
-                if "body" in d:
-                    body = d["body"].split("\n")
-                    if len(body) > 800:
-                        logger.info(
-                            f"Truncated body of id: {d['id']}, title: {d['title']} from {len(body)}"
-                        )
-                        d["body"] = "\n".join(body[:400])
-                        s = json.dumps(d, ensure_ascii=False)
+        history_data = []
+        lines = []
+        if self.blob_bodies:
+            dicts = [self.blobs.detach(d) for d in dicts]
+        for d in dicts:
+            line = codec.dumps_line(d)
+            history_data.append(line)
+
+            # truncate body if needed
+            if "body" in d:
+                body = self._rolling_body(d["body"])
+                if len(body) < len(d["body"]):
+                    logger.info(
+                        f"Truncated body of id: {d['id']}, title: {d['title']} from {len(d['body'])} chars"
+                    )
+                    line = codec.dumps_line({**d, "body": body})
+            lines.append(line)
+
+        if len(dicts) > 0:
+            data = b"".join(history_data)
+            member_size = None
+            if self.compress_history:
+                # an independent member per batch, so the index can seek to it
+                data = gzip.compress(data, compresslevel=6)
+                member_size = len(data)
+            offset = self.writer.write(history_path, data, rotate=True)
+            instrument.count(
+                "bytes_written", len(data), shard=os.path.basename(history_path)
+            )
+            index = self._shard_index(history_path, offset)
+            # a missing or stale sidecar is rebuilt from the file, batch included
+            if index.size == offset:
+                index.add(offset, history_data, dicts, member_size)
+            self.index.add(history_path, offset, history_data, dicts, member_size)
+            data = b"".join(lines)
+            self.writer.write(path, data)
+            instrument.count("bytes_written", len(data), shard=path)
+
+    @staticmethod
+    def _rolling_body(body: str) -> str:
+        lines = body.split("\n")
+        if len(lines) > ROLLING_BODY_MAX_LINES:
+            return "\n".join(lines[:ROLLING_BODY_LINES])
+        return body
+
+    def _shard_index(self, path: str, offset: int) -> ShardIndex:
+        index = self._shard_indexes.get(path)
+        if index is None or index.size != offset:
+            # also covers shards written before the index existed
+            index = self._shard_indexes[path] = ShardIndex.load(path)
+            if index.size != offset:
+                self.writer.flush()
+                index = self._shard_indexes[path] = ShardIndex.load_fresh(path)
+        return index
+
+    def _on_shard_rotated(self, path: str, new_path: str):
+        index = self._shard_indexes.pop(path, None) or ShardIndex.load(path)
+        index.move(new_path)
+        self.index.move(path, new_path)
+
+    def _save_shard_indexes(self):
+        for index in self._shard_indexes.values():
+            index.save()
+
+
+# stop gracefully instead of raising in the middle of a batch,
+# returns the previous handlers
+def _stop_on_signals(stop: threading.Event) -> dict:
+    handlers = {}
+    for sig in [signal.SIGTERM, signal.SIGINT]:
+        try:
+            handlers[sig] = signal.signal(sig, lambda *_: stop.set())
+        except ValueError:
+            # not the main thread
+            pass
+    return handlers
+
+
+# run stages together, cancel the others once any of them fails
+async def _gather_or_cancel(*coros):
+    tasks = [asyncio.ensure_future(c) for c in coros]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+def test_append_to_shard_without_sidecar(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    t = Tracker(tags=[], transformer=None)
+    path = os.path.join(t.history_folder, "transactions_000001000.jsonl")
+    txs = [{"id": f"t{i}", "block_height": 1000 + i} for i in range(4)]
+    with open(path, "wb") as f:
+        f.write(b"".join(codec.dumps_line(tx) for tx in txs[:3]))
+    t.append_to_file(1000, t.transactions_path, txs[3:])
+    t.writer.close()
+    t._save_shard_indexes()
+    assert ShardIndex.load(path).count == 4
+
+
+def test_split_large_history_files(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("GITHUB_ENV", str(tmp_path / "env"))
+    monkeypatch.setitem(globals(), "GITHUB_FILE_LIMIT", 100)
+    t = Tracker(tags=[], transformer=None)
+    txs = [{"id": f"t{i}", "block_height": 1000 + i} for i in range(20)]
+    path = os.path.join(t.history_folder, "transactions_000001000.jsonl")
+    with open(path, "wb") as f:
+        f.write(b"".join(codec.dumps_line(tx) for tx in txs))
+    from shard_index import read_history
+
+    # an oversized shard of an older version is split when a run publishes
+    t._publish(generate_feed=False, export_trace=False)
+    parts = history_files(t.history_folder, "transactions")
+    assert path not in parts and all(os.path.getsize(p) < 100 for p in parts)
+    assert list(read_history(t.history_folder, "transactions")) == txs
+
+
+# pages of txs by block height, cursors are offsets into the matching txs
+class _StubFetcher(object):
+    def __init__(self, txs: list[dict], fail_after: int = None, stall: bool = False):
+        self.txs = txs
+        # queries answered before the next one raises
+        self.fail_after = fail_after
+        # contents never arrive, until cancelled
+        self.stall = stall
+        self.queries: list[tuple] = []
+        self.cancelled = 0
+
+    def _page(self, cursor, min_block, max_block, limit):
+        if self.fail_after is not None and len(self.queries) >= self.fail_after:
+            raise RuntimeError("gateway down")
+        self.queries.append((cursor, min_block, max_block))
+        matching = [
+            tx
+            for tx in self.txs
+            if (min_block or 0) <= tx["block_height"] <= (max_block or math.inf)
+        ]
+        start = int(cursor or 0)
+        page = matching[start : start + (limit or 10)]
+        end = start + len(page)
+        return [dict(tx) for tx in page], end < len(matching), str(end)
+
+    async def fetch_transactions_async(self, cursor, min_block, limit=None):
+        await asyncio.sleep(0)
+        return self._page(cursor, min_block, None, limit)
+
+    async def fetch_ranges_async(self, ranges: list[tuple], limit=None):
+        await asyncio.sleep(0)
+        return [self._page(cursor, lo, hi, limit) for cursor, lo, hi in ranges]
+
+    async def current_block_height_async(self):
+        return self.txs[-1]["block_height"]
+
+    def take_content_digests(self, ids: list[str]) -> dict:
+        return {}
+
+    async def batch_fetch_data(self, ids: list[str], digests: dict = None):
+        try:
+            if self.stall:
+                await asyncio.Event().wait()
+            # later ranges finish first
+            await asyncio.sleep(0.001 * (len(self.txs) - int(ids[0][1:])))
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        return [{"id": _id, "title": _id, "timestamp": 1} for _id in ids]
+
+    async def close(self):
+        pass
+
+
+def _stub_txs(count: int, per_block: int = 3) -> list[dict]:
+    return [
+        {"id": f"t{i}", "block_height": 1000 + i // per_block, "block_timestamp": i}
+        for i in range(count)
+    ]
+
+
+def test_run_pipeline(tmp_path, monkeypatch):
+    from shard_index import read_history
+
+    monkeypatch.chdir(tmp_path)
+    txs = _stub_txs(25)
+    fetcher = _StubFetcher(txs[:20])
+    t = Tracker(tags=[], transformer=None, fetcher=fetcher)
+    t.batch_size = 6
+    cursors = []
+    commit = t._commit
+    t._commit = lambda *args: (commit(*args), cursors.append(t.checkpoint.query()))
+    t._run_async(t._run_pipeline(keep_tracking=True, deadline=time.time() + 60))
+    # the checkpoint moves page by page, once its files are written
+    assert cursors == [("6", None), ("12", None), ("18", None), ("20", None)]
+    assert t.checkpoint.block_height == 1006 and t.checkpoint.stats["posts"] == 20
+
+    # a new run continues from the saved cursor
+    fetcher.txs = txs
+    t = Tracker(tags=[], transformer=None, fetcher=fetcher)
+    t._run_async(t._run_pipeline(keep_tracking=False, deadline=time.time() + 60))
+    assert fetcher.queries[-1] == ("20", None, None)
+    assert t.checkpoint.query() == ("25", None)
+    t.writer.close()
+    assert list(read_history(t.history_folder, "transactions")) == txs
+    assert [p["id"] for p in read_history(t.history_folder, "posts")] == [
+        tx["id"] for tx in txs
+    ]
+
+    # contents still downloading are cancelled once paging fails
+    fetcher = _StubFetcher(txs, fail_after=1, stall=True)
+    t = Tracker(tags=[], transformer=None, fetcher=fetcher, root="failed")
+    try:
+        t._run_async(
+            asyncio.wait_for(t._run_pipeline(True, time.time() + 60), timeout=5)
+        )
+        assert False, "the pipeline did not fail"
+    except RuntimeError:
+        pass
+    assert fetcher.cancelled == 1 and t.checkpoint.query() == (None, None)
+
+
+def test_backfill(tmp_path, monkeypatch):
+    from shard_index import read_history
+
+    monkeypatch.chdir(tmp_path)
+    txs = _stub_txs(45)
+    fetcher = _StubFetcher(txs)
+    t = Tracker(tags=[], transformer=None, fetcher=fetcher)
+    # tracking stopped in the middle of block 1005
+    t._commit(t._group_by_key(txs[:17]), {}, cursor="17")
+    t.batch_size = 4
+    t.backfill(workers=2)
+    assert fetcher.queries[0] == (None, 1005, 1006)
+    # spools finish out of order but are merged by height, the resumed first
+    # range without what was already saved
+    assert list(read_history(t.history_folder, "transactions")) == txs
+    posts = [p["id"] for p in read_history(t.history_folder, "posts")]
+    assert posts == [tx["id"] for tx in txs[17:]]
+    assert t.checkpoint.block_height == 1014 and t.checkpoint.stats["posts"] == 28
+    assert not os.listdir(os.path.join(t.cache_folder, "backfill"))
+
+    # spooling ranges are cancelled once paging fails
+    fetcher = _StubFetcher(txs, fail_after=2, stall=True)
+    t = Tracker(tags=[], transformer=None, fetcher=fetcher, root="failed")
+    ranges = t._split_block_range(1000, 1014, 8)
+    try:
+        t._run_async(asyncio.wait_for(t._backfill(ranges, workers=2), timeout=5))
+        assert False, "the backfill did not fail"
+    except RuntimeError:
+        pass
+    assert fetcher.cancelled == 2 and t.checkpoint.block_height is None
+
+
+def test_content_digests_of_mirror_tags(tmp_path, monkeypatch):
+    from arweave import transform_tags
+
+    monkeypatch.chdir(tmp_path)
+    fetcher = ArweaveFetcher(tags=[], tags_transformer=transform_tags)
+    tags = [
+        {"name": "App-Name", "value": "MirrorXYZ"},
+        {"name": "Contributor", "value": "0x1"},
+        {"name": "Content-Digest", "value": "cd"},
+        {"name": "Original-Content-Digest", "value": "d"},
+    ]
+    node = {"id": "a", "tags": tags, "block": {"height": 1, "timestamp": 2}}
+    tx = fetcher.edge_to_transaction({"node": node})
+    # records keep their schema, the digest only goes to the content fetch
+    assert tx == {
+        "id": "a",
+        "block_height": 1,
+        "block_timestamp": 2,
+        "contributor": "0x1",
+        "original-content-digest": "d",
+    }
+    fetched = []
+
+    async def batch_fetch_data(ids: list[str], digests: dict = None):
+        fetched.append((ids, digests))
+        return []
+
+    fetcher.batch_fetch_data = batch_fetch_data
+    t = Tracker(tags=[], transformer=None, fetcher=fetcher)
+    t._run_async(t._fetch_contents([tx]))
+    assert fetched == [(["a"], {"a": "cd"})] and fetcher.content_digests == {}
+
+
+def test_import_budget():
+    import subprocess
+    import sys
 
-                f.write(s + "\n")
+    code = (
+        "import json, sys\n"
+        "import tracker\n"
+        "heavy = ['pandas', 'matplotlib', 'numpy', 'markdown', 'jsonfeed', 'gql', 'aiohttp']\n"
+        "print(json.dumps([m for m in heavy if m in sys.modules]))"
+    )
+    out = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True,
+        check=True,
+    ).stdout
+    loaded = codec.loads(out)
+    # heavy subsystems are imported by the commands that use them
+    assert loaded == []
@@ -1,10 +1,15 @@
-import asyncio
+import fcntl
+import glob
+import gzip
 import json
 import logging
 import os
-from typing import Union, Any, Optional
+import re
+import zlib
+from contextlib import contextmanager
+from typing import Iterator, Optional, Union
 
-import aiohttp
+import codec
 
 logging.basicConfig(
     level=logging.INFO,
@@ -16,24 +21,6 @@ logger.level = logging.getLevelName(
 )
 
 
-async def get(session: aiohttp.ClientSession, url: str, timeout: int = 10):
-    async with session.get(url, raise_for_status=True, timeout=timeout) as resp:
-        return await resp.json()
-
-
-async def batch_get(
-    urls: list[str],
-    timeout: int = 10,
-    return_exceptions=False,
-) -> tuple[Union[BaseException, Any], ...]:
-    async with aiohttp.ClientSession() as session:
-        tasks = []
-        for url in urls:
-            tasks.append(asyncio.ensure_future(get(session, url, timeout=timeout)))
-        results = await asyncio.gather(*tasks, return_exceptions=return_exceptions)
-        return results
-
-
 def read_last_line(path: str) -> Optional[str]:
     if not os.path.exists(path):
         return None
@@ -51,7 +38,7 @@ def read_last_jsonline(path: str) -> Optional[dict]:
     line = read_last_line(path)
     if line is None:
         return None
-    return json.loads(line)
+    return codec.loads(line)
 
 
 def test_read_last_line():
@@ -63,6 +50,211 @@ def test_read_last_line():
     assert json.loads(read_last_line("tests/line2.txt"))["foo"] == "bar"
 
 
+# yield lines from the end of file, reading fixed size blocks backwards
+def read_lines_reversed(path: str, block_size: int = 64 * 1024):
+    if not os.path.exists(path):
+        return
+    with open(path, "rb") as file:
+        position = file.seek(0, os.SEEK_END)
+        tail = b""
+        while position > 0:
+            size = min(block_size, position)
+            position -= size
+            file.seek(position)
+            lines = (file.read(size) + tail).split(b"\n")
+            # the first one may be a partial line
+            tail = lines.pop(0)
+            for line in reversed(lines):
+                if line:
+                    yield line.decode()
+        if tail:
+            yield tail.decode()
+
+
+def test_read_lines_reversed():
+    assert list(read_lines_reversed("tests/not_exists_file")) == []
+    assert list(read_lines_reversed("tests/line1.txt")) == ['{"foo": "bar"}']
+    assert len(list(read_lines_reversed("tests/line2.txt", block_size=4))) == 2
+
+
+# byte offset where the last `count` lines of the file start
+def offset_of_last_lines(path: str, count: int, block_size: int = 64 * 1024) -> int:
+    with open(path, "rb") as file:
+        position = file.seek(0, os.SEEK_END)
+        if count <= 0:
+            return position
+        # ignore the trailing newline of the last line
+        file.seek(max(0, position - 1))
+        if file.read(1) == b"\n":
+            position -= 1
+        while position > 0:
+            size = min(block_size, position)
+            position -= size
+            file.seek(position)
+            block = file.read(size)
+            end = len(block)
+            while (end := block.rfind(b"\n", 0, end)) >= 0:
+                count -= 1
+                if count == 0:
+                    return position + end + 1
+        return 0
+
+
+def test_offset_of_last_lines():
+    assert offset_of_last_lines("tests/line2.txt", 1) == 15
+    assert offset_of_last_lines("tests/line2.txt", 2) == 0
+    assert offset_of_last_lines("tests/line2.txt", 3, block_size=4) == 0
+    assert offset_of_last_lines("tests/line2.txt", 0) == 30
+
+
+# history shards: name_000935000.jsonl, and split parts name_000935000.1.jsonl
+# (.N.json for parts split by old versions)
+_SHARD_PATTERN = re.compile(r"^(.+)_(\d+)(?:\.(\d+))?\.(jsonl|json|jsonl\.gz)$")
+GZIP_SUFFIX = ".gz"
+
+
+def parse_shard_name(path: str) -> Optional[tuple[str, int, Optional[int]]]:
+    m = _SHARD_PATTERN.match(os.path.basename(path))
+    if m is None:
+        return None
+    name, key, part, _ = m.groups()
+    return name, int(key), int(part) if part is not None else None
+
+
+# e.g. "jsonl" or "jsonl.gz"
+def shard_extension(path: str) -> str:
+    return _SHARD_PATTERN.match(os.path.basename(path)).group(4)
+
+
+def is_compressed(path: str) -> bool:
+    return path.endswith(GZIP_SUFFIX)
+
+
+# extensions of the same shard in the order they were written, e.g. compression
+# turned on in the middle of a bucket starts a gz shard next to the plain one
+SHARD_EXTENSIONS = ["json", "jsonl", "jsonl.gz"]
+
+
+# parts are split from the base file, so they are older than it
+def shard_sort_key(path: str):
+    name, key, part = parse_shard_name(path)
+    ext = SHARD_EXTENSIONS.index(shard_extension(path))
+    return name, key, part if part is not None else float("inf"), ext
+
+
+def history_files(folder: str, name: str) -> list[str]:
+    paths = [
+        p
+        for p in glob.glob(os.path.join(folder, f"{name}_*"))
+        if (parsed := parse_shard_name(p)) and parsed[0] == name
+    ]
+    return sorted(paths, key=shard_sort_key)
+
+
+def test_shard_sort_key():
+    paths = ["t_000001000.jsonl", "t_000000000.jsonl", "t_000001000.10.jsonl"]
+    paths += ["t_000001000.2.json", "t_000001000.1.jsonl"]
+    assert sorted(paths, key=shard_sort_key) == [
+        "t_000000000.jsonl",
+        "t_000001000.1.jsonl",
+        "t_000001000.2.json",
+        "t_000001000.10.jsonl",
+        "t_000001000.jsonl",
+    ]
+    # plain before gz whatever order they are listed in
+    assert sorted(
+        ["t_000001000.jsonl.gz", "t_000001000.jsonl"], key=shard_sort_key
+    ) == [
+        "t_000001000.jsonl",
+        "t_000001000.jsonl.gz",
+    ]
+    assert parse_shard_name("t_000001000.jsonl.idx") is None
+    assert parse_shard_name("t_000001000.3.jsonl.gz") == ("t", 1000, 3)
+    assert shard_extension("t_000001000.3.jsonl.gz") == "jsonl.gz"
+
+
+# binary lines of a shard from offset, compressed shards are gzip members
+# appended one after another, so the offset must be at a member boundary
+@contextmanager
+def open_shard(path: str, offset: int = 0):
+    with open(path, "rb") as f:
+        f.seek(offset)
+        if is_compressed(path):
+            with gzip.GzipFile(fileobj=f, mode="rb") as g:
+                yield g
+        else:
+            yield f
+
+
+# (offset, compressed size, data) of each complete gzip member from offset
+def gzip_members(
+    path: str, offset: int = 0, block_size: int = 1024 * 1024
+) -> Iterator[tuple[int, int, bytes]]:
+    with open(path, "rb") as f:
+        f.seek(offset)
+        d = zlib.decompressobj(wbits=31)
+        start = pos = offset
+        out = []
+        buf = b""
+        while True:
+            if not buf:
+                buf = f.read(block_size)
+                if not buf:
+                    break
+            out.append(d.decompress(buf))
+            pos += len(buf) - len(d.unused_data)
+            if d.eof:
+                yield start, pos - start, b"".join(out)
+                buf = d.unused_data
+                d = zlib.decompressobj(wbits=31)
+                start = pos
+                out = []
+            else:
+                buf = b""
+
+
+def test_gzip_members(tmp_path):
+    path = str(tmp_path / "t_000000000.jsonl.gz")
+    members = [gzip.compress(b"a\nb\n"), gzip.compress(b"c\n")]
+    with open(path, "wb") as f:
+        f.write(b"".join(members))
+    assert list(gzip_members(path, block_size=7)) == [
+        (0, len(members[0]), b"a\nb\n"),
+        (len(members[0]), len(members[1]), b"c\n"),
+    ]
+    with open_shard(path, len(members[0])) as f:
+        assert f.read() == b"c\n"
+
+
+# write to a temp file then rename, readers never see a partial file
+def atomic_write(path: str, data: Union[str, bytes]):
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb" if isinstance(data, bytes) else "w") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+# exclusive lock between processes writing the same history, e.g. tracking and compaction,
+# the second one fails right away instead of waiting
+@contextmanager
+def history_lock(path: str):
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    with open(path, "a") as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise Exception(f"History is in use by another process, see {path}")
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
 def lines_of_file(path: str) -> int:
     with open(path, "r") as f:
         return len(f.readlines())
@@ -74,6 +266,17 @@ def chunks(lst, n):
         yield lst[i : i + n]
 
 
+# files of each key put in this process, so trackers sharing a run add up
+_github_action_files: dict[str, list[str]] = {}
+
+
+def put_github_action_files(key: str, paths: list[str]):
+    files = _github_action_files.setdefault(key, [])
+    files.extend(p for p in paths if p not in files)
+    # the last value of a key wins
+    put_github_action_env(key, "\n".join(files))
+
+
 def put_github_action_env(key: str, value: str):
     env_file = os.getenv("GITHUB_ENV")
     if env_file is None:
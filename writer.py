@@ -0,0 +1,121 @@
+import os
+from collections import OrderedDict
+
+from util import logger, parse_shard_name, history_files, shard_extension
+
+
+# append-only writer keeping recently used files open with buffered writes,
+# history shards are rotated before they grow over max_bytes
+class ShardWriter(object):
+    def __init__(
+        self,
+        max_bytes: int,
+        max_open: int = 16,
+        buffer_size: int = 1024 * 1024,
+        # called with (old path, new path) after a shard is rotated
+        on_rotate=None,
+    ):
+        self.max_bytes = max_bytes
+        self.on_rotate = on_rotate
+        self.max_open = max_open
+        self.buffer_size = buffer_size
+        self._files: OrderedDict = OrderedDict()
+        self._sizes: dict[str, int] = {}
+
+    def _open(self, path: str):
+        if f := self._files.get(path):
+            self._files.move_to_end(path)
+            return f
+        while len(self._files) >= self.max_open:
+            _, oldest = self._files.popitem(last=False)
+            oldest.close()
+        f = open(path, "ab", buffering=self.buffer_size)
+        self._files[path] = f
+        self._sizes[path] = f.tell()
+        return f
+
+    def _close(self, path: str):
+        if f := self._files.pop(path, None):
+            f.close()
+
+    def size(self, path: str) -> int:
+        if path in self._sizes:
+            return self._sizes[path]
+        return os.path.getsize(path) if os.path.exists(path) else 0
+
+    # data is one or more complete lines, returns the offset it is written at
+    def write(self, path: str, data: bytes, rotate: bool = False) -> int:
+        if (
+            rotate
+            and 0 < self.size(path)
+            and self.size(path) + len(data) > self.max_bytes
+        ):
+            self._rotate(path)
+        f = self._open(path)
+        offset = self._sizes[path]
+        f.write(data)
+        self._sizes[path] += len(data)
+        return offset
+
+    # move the full shard to the next part, parts are older than the base file
+    def _rotate(self, path: str) -> str:
+        self._close(path)
+        folder = os.path.dirname(path)
+        name, key, _ = parse_shard_name(path)
+        part = 1
+        for p in history_files(folder, name):
+            _, k, n = parse_shard_name(p)
+            if k == key and n is not None:
+                part = max(part, n + 1)
+        ext = shard_extension(path)
+        new_path = os.path.join(folder, f"{name}_{key:09d}.{part}.{ext}")
+        # not opened yet when it was full already before this run
+        logger.info(f"Rotating {path} ({self.size(path)} bytes) to {new_path}")
+        os.replace(path, new_path)
+        self._sizes[path] = 0
+        if self.on_rotate:
+            self.on_rotate(path, new_path)
+        return new_path
+
+    def flush(self):
+        for f in self._files.values():
+            f.flush()
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        self._files.clear()
+        self._sizes.clear()
+
+
+def test_shard_writer(tmp_path):
+    path = str(tmp_path / "t_000001000.jsonl")
+    rotated = []
+    w = ShardWriter(max_bytes=10, max_open=1, on_rotate=lambda a, b: rotated.append(b))
+    for i in range(5):
+        assert w.write(path, b"%d123\n" % i, rotate=True) == (i % 2) * 5
+        w.write(str(tmp_path / "other.jsonl"), b"x\n")
+    w.close()
+
+    files = history_files(str(tmp_path), "t")
+    assert [os.path.basename(p) for p in files] == [
+        "t_000001000.1.jsonl",
+        "t_000001000.2.jsonl",
+        "t_000001000.jsonl",
+    ]
+    assert rotated == files[:2]
+    assert b"".join(open(p, "rb").read() for p in files) == b"".join(
+        b"%d123\n" % i for i in range(5)
+    )
+    assert open(tmp_path / "other.jsonl", "rb").read() == b"x\n" * 5
+
+
+def test_rotate_existing_shard(tmp_path):
+    path = str(tmp_path / "t_000001000.jsonl")
+    with open(path, "wb") as f:
+        f.write(b"0123456789\n")
+    w = ShardWriter(max_bytes=10)
+    assert w.write(path, b"a\n", rotate=True) == 0
+    w.close()
+    assert open(tmp_path / "t_000001000.1.jsonl", "rb").read() == b"0123456789\n"
+    assert open(path, "rb").read() == b"a\n"